@@ -0,0 +1,330 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+#
+#     Copyright (C) 2015 Team Kodi
+#     http://kodi.tv
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Builds synthetic git and binary addon repositories in a temporary directory and times the individual
+packaging and indexing phases on them. Results are written as JSON so runs of different commits can be
+compared.
+"""
+
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import stat
+import subprocess
+import tempfile
+import time
+import zipfile
+from argparse import ArgumentParser
+
+import packager
+import packager.binarypackaging
+import packager.cache
+import packager.catalog
+import packager.gitbackend
+import packager.gitpackaging
+import packager.textures
+import updaterepo
+from indexer import indexer
+
+logger = logging.getLogger("benchmark")
+
+STUB_TEXTUREPACKER = """#!/bin/sh
+# Stand-in for TexturePacker: writes an empty .xbt to the -output path.
+[ $# -eq 0 ] && exit 1
+while [ $# -gt 0 ]; do
+    if [ "$1" = "-output" ]; then
+        : > "$2"
+    fi
+    shift
+done
+"""
+
+ADDON_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<addon id="{addon_id}" version="{version}" name="{addon_id}" provider-name="benchmark">
+  <requires>
+    <import addon="xbmc.python" version="2.25.0"/>
+  </requires>
+  {extension}
+  <extension point="xbmc.addon.metadata">
+    <summary lang="en_GB">Synthetic benchmark addon</summary>
+    <assets>
+      <icon>icon.png</icon>
+      <fanart>fanart.jpg</fanart>
+    </assets>
+  </extension>
+</addon>
+"""
+
+SCRIPT_EXTENSION = '<extension point="xbmc.python.script" library="default.py"/>'
+SKIN_EXTENSION = '<extension point="xbmc.gui.skin" debugging="false"/>'
+
+
+def git(repo, *args):
+    env = dict(os.environ, GIT_AUTHOR_NAME='benchmark', GIT_AUTHOR_EMAIL='benchmark@localhost',
+               GIT_COMMITTER_NAME='benchmark', GIT_COMMITTER_EMAIL='benchmark@localhost')
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(['git'] + list(args), cwd=repo, env=env, stdout=devnull)
+
+
+def write_file(path, data):
+    packager.utils.makedirs_ignore_errors(os.path.dirname(path))
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def random_bytes(rng, size):
+    return bytearray(rng.getrandbits(8) for _ in range(size))
+
+
+def write_addon(addon_dir, addon_id, version, is_skin, args, rng):
+    extension = SKIN_EXTENSION if is_skin else SCRIPT_EXTENSION
+    write_file(os.path.join(addon_dir, 'addon.xml'),
+               ADDON_XML.format(addon_id=addon_id, version=version, extension=extension).encode('utf-8'))
+    if os.path.exists(os.path.join(addon_dir, 'icon.png')):
+        # only addon.xml changes between versions, like most real version bumps
+        return
+
+    write_file(os.path.join(addon_dir, 'icon.png'), random_bytes(rng, args.file_size))
+    write_file(os.path.join(addon_dir, 'fanart.jpg'), random_bytes(rng, args.file_size))
+    write_file(os.path.join(addon_dir, 'default.py'), b"print('benchmark')\n" * (args.file_size // 20))
+    for i in range(args.files):
+        write_file(os.path.join(addon_dir, 'resources', 'lib', 'module%d.py' % i),
+                   b"# synthetic module\n" * (args.file_size // 20))
+    if is_skin:
+        for i in range(args.textures):
+            write_file(os.path.join(addon_dir, 'media', 'texture%d.png' % i), random_bytes(rng, args.file_size))
+        for theme in ('default', 'dark'):
+            for i in range(args.textures // 2):
+                write_file(os.path.join(addon_dir, 'themes', theme, 'texture%d.png' % i),
+                           random_bytes(rng, args.file_size))
+
+
+def build_source_repo(root, args, rng):
+    """
+    Creates an upstream repo with `args.versions` commits, each bumping the version of every addon, and
+    branches pointing at the last commits. Returns the path of a clone with `origin/*` refs.
+    """
+    upstream = os.path.join(root, 'upstream-source')
+    os.makedirs(upstream)
+    git(upstream, 'init', '-q')
+    commits = []
+    for version in range(args.versions):
+        for i in range(args.addons):
+            is_skin = i < args.skins
+            addon_id = ('skin.bench%d' if is_skin else 'script.bench%d') % i
+            write_addon(os.path.join(upstream, addon_id), addon_id, '1.0.%d' % version, is_skin, args, rng)
+        git(upstream, 'add', '-A')
+        git(upstream, 'commit', '-q', '-m', 'version %d' % version)
+        commits.append(subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=upstream).strip().decode('ascii'))
+
+    for i in range(args.branches):
+        git(upstream, 'branch', 'branch%d' % i, commits[max(0, len(commits) - 1 - i)])
+
+    clone = os.path.join(root, 'source')
+    git(root, 'clone', '-q', upstream, clone)
+    return clone
+
+
+def build_config_repo(root, args):
+    upstream = os.path.join(root, 'upstream-config')
+    os.makedirs(upstream)
+    git(upstream, 'init', '-q')
+    targets = ''
+    for i in range(args.targets):
+        targets += '[target%d]\nbranches = branch%d\nminversions = xbmc.python:2.25.0\n\n' % (i, i % args.branches)
+    write_file(os.path.join(upstream, 'targets.cfg'), targets.encode('utf-8'))
+    git(upstream, 'add', '-A')
+    git(upstream, 'commit', '-q', '-m', 'targets')
+    git(upstream, 'branch', '-M', 'master')
+
+    clone = os.path.join(root, 'config')
+    git(root, 'clone', '-q', upstream, clone)
+    return clone
+
+
+def build_binary_repo(root, args, rng):
+    location = os.path.join(root, 'binary')
+    for branch in range(args.branches):
+        for i in range(args.binary_addons):
+            addon_id = 'audiodecoder.bench%d' % i
+            for platform_name in ['platform%d' % p for p in range(args.platforms)]:
+                addon_dir = os.path.join(location, 'branch%d' % branch, '%s+%s' % (addon_id, platform_name))
+                packager.utils.makedirs_ignore_errors(addon_dir)
+                for version in range(args.versions):
+                    version = '1.0.%d' % version
+                    with zipfile.ZipFile(os.path.join(addon_dir, '%s-%s.zip' % (addon_id, version)), 'w',
+                                         zipfile.ZIP_DEFLATED) as zf:
+                        zf.writestr(addon_id + '/addon.xml', ADDON_XML.format(
+                            addon_id=addon_id, version=version, extension=''))
+                        zf.writestr(addon_id + '/icon.png', bytes(random_bytes(rng, args.file_size)))
+                        zf.writestr(addon_id + '/fanart.jpg', bytes(random_bytes(rng, args.file_size)))
+                        zf.writestr(addon_id + '/lib.so', bytes(random_bytes(rng, args.file_size * 10)))
+    return location
+
+
+class Timer(object):
+    def __init__(self):
+        self.results = {}
+
+    def time(self, phase, func, *args):
+        start = time.time()
+        result = func(*args)
+        elapsed = time.time() - start
+        self.results[phase] = self.results.get(phase, 0.0) + elapsed
+        logger.info("%-32s %8.3fs", phase, elapsed)
+        return result
+
+
+def add_old_versions(target_dir, count):
+    """ Adds copies of every zip under older version numbers, so that there is something to prune. """
+    for addon_dir in os.listdir(target_dir):
+        addon_path = os.path.join(target_dir, addon_dir)
+        if not os.path.isdir(addon_path):
+            continue
+        for name in [name for name in os.listdir(addon_path) if name.endswith('.zip')]:
+            addon_id = name.rsplit('-', 1)[0]
+            for i in range(count):
+                shutil.copyfile(os.path.join(addon_path, name), os.path.join(addon_path, '%s-0.0.%d.zip' % (addon_id, i)))
+
+
+def run(root, args):
+    rng = random.Random(args.seed)
+    logger.info("Building synthetic repositories in %s", root)
+    source = build_source_repo(root, args, rng)
+    config_repo = build_config_repo(root, args)
+    binary = build_binary_repo(root, args, rng)
+    destination = os.path.join(root, 'destination')
+    os.makedirs(destination)
+
+    stub = os.path.join(root, 'TexturePacker')
+    write_file(stub, STUB_TEXTUREPACKER.encode('utf-8'))
+    os.chmod(stub, os.stat(stub).st_mode | stat.S_IEXEC)
+    packager.textures.texturepacker_binary = stub
+    packager.cache.cache_dir = os.path.join(root, 'cache')
+
+    config = updaterepo.config
+    for section, options in [
+            ('configuration_repo', {'location': config_repo, 'branch': 'master', 'remote_name': 'origin',
+                                    'filename': 'targets.cfg'}),
+            ('debug', {'fetch_remotes': 'false'})]:
+        if not config.has_section(section):
+            config.add_section(section)
+        for key, value in options.items():
+            config.set(section, key, value)
+
+    timer = Timer()
+    targets = timer.time('read_targets', lambda: list(updaterepo.read_targets()))
+
+    for target in targets:
+        refs = ['origin/' + branch for branch in target.branches]
+        binary_repos = [os.path.join(binary, branch) for branch in target.branches]
+        dest = os.path.join(destination, target.name)
+        os.makedirs(dest)
+
+        artifacts = timer.time('collect_artifacts', lambda: list(packager.gitpackaging.filter_latest_version(
+            packager.gitpackaging.collect_artifacts([source], refs, target.min_versions))))
+        timer.time('collect_artifacts (unchanged)', lambda: list(
+            packager.gitpackaging.collect_artifacts([source], refs, target.min_versions)))
+        binary_artifacts = timer.time('collect_binary_artifacts', lambda: list(
+            packager.binarypackaging.filter_latest_version(
+                packager.binarypackaging.collect_artifacts(binary_repos, target.min_versions))))
+
+        def write_all():
+            for artifact in artifacts:
+                outdir = os.path.join(dest, artifact.addon_id)
+                packager.utils.makedirs_ignore_errors(outdir)
+                packager.gitpackaging.write_artifact(artifact, outdir)
+        timer.time('write_artifact', write_all)
+
+        def write_all_binary():
+            for artifact in binary_artifacts:
+                outdir = os.path.join(dest, '%s+%s' % (artifact.addon_id, artifact.platform))
+                packager.utils.makedirs_ignore_errors(outdir)
+                packager.binarypackaging.write_artifact(artifact, outdir)
+        timer.time('write_binary_artifact', write_all_binary)
+
+        add_old_versions(dest, args.versions)
+        # the artifacts were written without a catalog, build it here so that pruning is timed on its own
+        timer.time('build_catalog', lambda: packager.catalog.Catalog(dest).close())
+        timer.time('delete_old_artifacts', packager.delete_old_artifacts, dest, 3)
+
+        index = os.path.join(dest, 'addons.xml')
+        timer.time('create_index', indexer.create_index, dest, index)
+        timer.time('create_index (unchanged)', indexer.create_index, dest, index)
+
+    packager.gitbackend.close_all()
+    return timer.results
+
+
+def current_commit():
+    try:
+        output = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)))
+        return output.strip().decode('ascii')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--addons', type=int, default=50, help="number of addons in the git repo")
+    parser.add_argument('--skins', type=int, default=2, help="how many of the addons are skins")
+    parser.add_argument('--versions', type=int, default=3, help="number of versions (commits) of each addon")
+    parser.add_argument('--branches', type=int, default=2)
+    parser.add_argument('--targets', type=int, default=2)
+    parser.add_argument('--binary-addons', dest='binary_addons', type=int, default=5)
+    parser.add_argument('--platforms', type=int, default=3, help="platforms per binary addon")
+    parser.add_argument('--files', type=int, default=10, help="extra files per addon")
+    parser.add_argument('--textures', type=int, default=20, help="textures per skin")
+    parser.add_argument('--file-size', dest='file_size', type=int, default=4096)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--keep', action='store_true', default=False, help="keep the generated repositories")
+    parser.add_argument('-o', '--output', dest='output', default='benchmark.json')
+    args = parser.parse_args()
+
+    # the indexer configures the root logger when imported
+    logging.getLogger().setLevel(logging.WARNING)
+    logger.setLevel(logging.INFO)
+
+    root = tempfile.mkdtemp(prefix='repository-generator-benchmark-')
+    try:
+        timings = run(root, args)
+    finally:
+        if args.keep:
+            logger.info("Kept generated repositories in %s", root)
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+    result = {
+        'commit': current_commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'parameters': vars(args),
+        'timings': timings,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(result, f, indent=2, sort_keys=True)
+    logger.info("Results written to %s", args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -20,16 +20,138 @@
 import os
 import re
 import gzip
+import hashlib
+import json
 import logging
 import zipfile
 from lxml import etree as ET
-from xml.dom import minidom
 from distutils.version import LooseVersion
+from packager import catalog
+from packager import changes
+from packager.store import file_hash
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 #logging.basicConfig(level=logging.DEBUG)
 logging.basicConfig(level=logging.INFO)
 #logging.basicConfig(level=logging.WARN)
 
+CACHE_FILENAME = '.addons-cache.json'
+STATE_FILENAME = '.index-state.json'
+XML_DECLARATION = b"<?xml version='1.0' encoding='utf-8'?>\n"
+
+
+class HashingWriter(object):
+    """ Writes to `fileobj` and feeds everything written to one hash per algorithm in `checksums`. """
+
+    def __init__(self, fileobj, checksums):
+        self.fileobj = fileobj
+        self.hashes = [(name, hashlib.new(name)) for name in checksums]
+
+    def write(self, data):
+        for _, digest in self.hashes:
+            digest.update(data)
+        self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+
+class CompressingWriter(object):
+    """ Writes to `fileobj` through a compressor object with a compress/flush interface. """
+
+    def __init__(self, fileobj, compressor):
+        self.fileobj = fileobj
+        self.compressor = compressor
+
+    def write(self, data):
+        self.fileobj.write(self.compressor.compress(data))
+
+    def close(self):
+        self.fileobj.write(self.compressor.flush())
+
+
+def format_supported(fmt):
+    return fmt == 'gz' or (fmt == 'xz' and lzma is not None) or (fmt == 'zst' and zstandard is not None)
+
+
+def open_compressor(fmt, path, fileobj):
+    """ Returns a writer compressing to `fileobj` in format `fmt`. """
+    if fmt == 'gz':
+        return gzip.GzipFile(path, 'wb', compresslevel=9, fileobj=fileobj, mtime=0)
+    if fmt == 'xz':
+        return CompressingWriter(fileobj, lzma.LZMACompressor(preset=9))
+    if fmt == 'zst':
+        return CompressingWriter(fileobj, zstandard.ZstdCompressor(level=19).compressobj())
+    raise ValueError("Unsupported index format '%s'" % fmt)
+
+
+class IndexWriter(object):
+    """
+    Streams an index to `dest` and to one compressed file per format in `formats`, hashing every output for
+    its checksum sidecar files on the way. The outputs are written to temporary files that replace the
+    published ones on commit(). `digest` is the sha256 of the uncompressed index.
+    """
+
+    def __init__(self, dest, formats, checksums):
+        self.digest = hashlib.sha256()
+        self.outputs = []
+        for path, fmt in [(dest, None)] + [(dest + '.' + fmt, fmt) for fmt in formats]:
+            f = open(path + '.tmp', 'wb')
+            hashing = HashingWriter(f, checksums)
+            writer = hashing if fmt is None else open_compressor(fmt, path, hashing)
+            self.outputs.append((path, f, hashing, writer))
+        self.closed = False
+
+    def write(self, data):
+        self.digest.update(data)
+        for _, _, _, writer in self.outputs:
+            writer.write(data)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for _, f, hashing, writer in self.outputs:
+            if writer is not hashing:
+                writer.close()
+            f.close()
+
+    def commit(self):
+        self.close()
+        for path, _, hashing, _ in self.outputs:
+            changes.written(path)
+            os.rename(path + '.tmp', path)
+            for name, digest in hashing.hashes:
+                changes.written(path + '.' + name)
+                with open(path + '.' + name, 'w') as f:
+                    f.write(digest.hexdigest())
+
+    def discard(self):
+        self.close()
+        for path, _, _, _ in self.outputs:
+            os.remove(path + '.tmp')
+
+
+def serialize_addon(tree, prettify):
+    """ Returns the serialized <addon> element `tree` as it appears inside <addons>. """
+    if prettify:
+        ET.indent(tree, space='  ', level=1)
+        return b'\n  ' + ET.tostring(tree, encoding='utf-8')
+    return ET.tostring(tree, encoding='utf-8')
+
+
 def split_version(path):
     result = os.path.splitext(os.path.basename(path))
     # extract name and version from file name
@@ -47,6 +169,11 @@ def split_version(path):
 
 
 def find_archives(repo_dir):
+    if catalog.exists(repo_dir):
+        for path in catalog.latest_archives(repo_dir, lambda name: split_version(name) != (None, None)):
+            yield path
+        return
+
     for addon_id in os.listdir(repo_dir):
         logging.debug("find_archives repo_dir: {} addon_id {}".format(repo_dir, addon_id))
         if os.path.isdir(os.path.join(repo_dir, addon_id)):
@@ -59,71 +186,236 @@ def find_archives(repo_dir):
                 yield zips[0]
 
 
-def create_index(repo_dir, dest, prettify=False):
+def read_cache(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def write_cache(path, cache):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(cache, f)
+    os.rename(path + '.tmp', path)
+
+
+def read_addon(archive, repo_dir, parser):
+    """ Opens `archive` and returns its <addon> element as it should appear in the index. """
+    addon_id, version = split_version(archive)
+    if (addon_id is None or version is None):
+        logging.exception("Failed to parse addon version from '%s'. Skipping" % archive)
+        return None
+
+    with zipfile.ZipFile(archive, 'r') as zf:
+        tree = None
+
+        logging.info("parsing archive {}: addon_id: {}, version: {}".format(archive, addon_id, version))
+        try:
+            tree = ET.fromstring(zf.read(os.path.join(addon_id, 'addon.xml')), parser)
+        except (ET.ParseError, KeyError, IndexError) as e:
+            logging.exception("Failed to read addon info from '%s'. Skipping" % archive)
+            return None
+
+        if tree.get('id') != addon_id or tree.get('version') != version:
+            logging.warning("archive {} has version mismatch between filename-parsed id/version ({}, {}) and addon.xml id/version ({}, {})".format(archive, addon_id, version, tree.get('id'), tree.get('version')))
+
+        metadata_elem = tree.find("./extension[@point='kodi.addon.metadata']")
+        if metadata_elem is None:
+            metadata_elem = tree.find("./extension[@point='xbmc.addon.metadata']")
+
+        # for backwards compatibility with add-ons that do not use the assets element
+        if metadata_elem.find('./assets') is None:
+            no_things = ['icon.png', 'fanart.jpg', 'changelog.txt']
+            for no_thing in no_things:
+                if os.path.join(addon_id, no_thing) not in zf.namelist():
+                    elem = ET.SubElement(metadata_elem, 'no' + os.path.splitext(no_thing)[0])
+                    elem.text = "true"
+
+        elem = ET.SubElement(metadata_elem, 'size')
+        elem.text = str(os.path.getsize(archive))
+
+        elem = ET.SubElement(metadata_elem, 'path')
+        elem.text = str(os.path.relpath(archive, repo_dir))
+
+        return tree
+
+
+def publish_delta(repo_dir, dest, state, addons, changed, keep, formats, checksums):
+    """
+    Writes the changes since the previous generation of the index as a delta file next to `dest`, and a
+    manifest pointing at the current generation and the last `keep` deltas. `addons` maps the addon
+    directory of every addon in the new index to its id and version, `changed` yields the serialized
+    <addon> elements that differ from the previous generation recorded in `state`. Records the new
+    generation in `state`.
+    """
+    base = os.path.splitext(dest)[0]
+    manifest_path = base + '-manifest.json'
+    manifest = read_cache(manifest_path)
+    deltas = manifest.get('deltas', [])
+
+    # every published generation but the first gets a delta, so that clients can follow the chain. The delta
+    # after an empty index, or after the state was lost, lists every addon.
+    previous = state.get('generation', manifest.get('generation', 0))
+    generation = previous + 1
+    old_addons = state.get('addons', {})
+
+    if previous:
+        delta_path = "%s-delta-%d.xml" % (base, generation)
+        logging.info("Writing {}".format(delta_path))
+        writer = IndexWriter(delta_path, formats, checksums)
+        try:
+            writer.write(XML_DECLARATION)
+            writer.write(b'<addons from="%d" generation="%d">' % (generation - 1, generation))
+            for data in changed:
+                writer.write(data)
+            for name, old in sorted(old_addons.items()):
+                if name not in addons:
+                    writer.write(ET.tostring(ET.Element(
+                        'removed', {'id': old['id'], 'version': old['version'], 'path': name}), encoding='utf-8'))
+            writer.write(b'</addons>')
+        except BaseException:
+            writer.discard()
+            raise
+        writer.commit()
+        deltas.append({'from': generation - 1, 'to': generation, 'path': os.path.basename(delta_path)})
+
+    for old in deltas[:-keep]:
+        for name in os.listdir(repo_dir):
+            if name.startswith(old['path']):
+                changes.deleted(os.path.join(repo_dir, name))
+                os.remove(os.path.join(repo_dir, name))
+    deltas = deltas[-keep:]
+
+    changes.written(manifest_path)
+    write_cache(manifest_path, {'generation': generation, 'index': os.path.basename(dest),
+                                'formats': formats, 'deltas': deltas})
+    state['generation'] = generation
+    state['addons'] = addons
+
+
+def index_options(config):
+    """ Returns the create_index keyword arguments configured in the [general] section of `config`. """
+    def config_list(option, default):
+        if not config.has_option('general', option):
+            return default
+        return [value.strip() for value in config.get('general', option).split(',') if value.strip()]
+
+    return {
+        'formats': config_list('index_formats', ['gz']),
+        'checksums': config_list('index_checksums', []),
+        'deltas': config.getint('general', 'index_deltas') if config.has_option('general', 'index_deltas') else 0,
+    }
+
+
+def create_index(repo_dir, dest, prettify=False, formats=('gz',), checksums=(), deltas=0):
+    """
+    Writes the index `dest` of the archives in `repo_dir`. Returns whether it changed. The hash of the new
+    index is computed from the cached <addon> elements first, and the index is only streamed to its
+    outputs, one <addon> element at a time, when that hash differs from the published one.
+    """
     parser = ET.XMLParser(remove_blank_text=True)
-    addons = ET.Element('addons')
 
-    archives = list(find_archives(repo_dir))
-    archives.sort(key=lambda _: os.stat(_).st_mtime, reverse=True)
+    for fmt in formats:
+        if not format_supported(fmt):
+            logging.warning("Index format '{}' is not supported or its module is not installed".format(fmt))
+    formats = [fmt for fmt in formats if format_supported(fmt)]
 
-    for archive in archives:
-        addon_id, version = split_version(archive)
-        if (addon_id is None or version is None):
-            logging.exception("Failed to parse addon version from '%s'. Skipping" % archive)
-            continue
+    # <addon> elements of previous runs, keyed by archive path and valid as long as size and mtime match.
+    # Entries are moved to the new cache as they are used, so that each element is held once.
+    cache_path = os.path.join(repo_dir, CACHE_FILENAME)
+    old_cache = read_cache(cache_path)
+    cache = {}
+    cache_changed = False
 
-        with zipfile.ZipFile(archive, 'r') as zf:
-            tree = None
+    # hash of the published index, and the addons of the last generation for deltas
+    state_path = os.path.join(repo_dir, STATE_FILENAME)
+    state = read_cache(state_path)
+    old_addons = state.get('addons', {}) if deltas > 0 else {}
+    addons = {}
+    changed = []
 
-            logging.info("parsing archive {}: addon_id: {}, version: {}".format(archive, addon_id, version))
-            try:
-                tree = ET.fromstring(zf.read(os.path.join(addon_id, 'addon.xml')), parser)
-            except (ET.ParseError, KeyError, IndexError) as e:
-                logging.exception("Failed to read addon info from '%s'. Skipping" % archive)
-                continue
+    archives = [(archive, os.stat(archive)) for archive in find_archives(repo_dir)]
+    archives.sort(key=lambda _: _[1].st_mtime, reverse=True)
 
-            if tree.get('id') != addon_id or tree.get('version') != version:
-                logging.warning("archive {} has version mismatch between filename-parsed id/version ({}, {}) and addon.xml id/version ({}, {})".format(archive, addon_id, version, tree.get('id'), tree.get('version')))
+    listed = []
+    for archive, stat in archives:
+        key = os.path.relpath(archive, repo_dir)
+        entry = old_cache.pop(key, None)
+        if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+            tree = None
+        else:
+            cache_changed = True
+            tree = read_addon(archive, repo_dir, parser)
+            if tree is None:
+                continue
+            entry = {'size': stat.st_size, 'mtime': stat.st_mtime, 'xml': ET.tostring(tree, encoding='unicode')}
+        cache[key] = entry
+        listed.append(key)
 
-            metadata_elem = tree.find("./extension[@point='kodi.addon.metadata']")
-            if metadata_elem is None:
-                metadata_elem = tree.find("./extension[@point='xbmc.addon.metadata']")
+        if deltas > 0:
+            if tree is None:
+                tree = ET.fromstring(entry['xml'].encode('utf-8'), parser)
+            name = os.path.dirname(key)
+            addons[name] = {'id': tree.get('id'), 'version': tree.get('version')}
+            if addons[name] != old_addons.get(name):
+                changed.append(key)
 
-            # for backwards compatibility with add-ons that do not use the assets element
-            if metadata_elem.find('./assets') is None:
-                no_things = ['icon.png', 'fanart.jpg', 'changelog.txt']
-                for no_thing in no_things:
-                    if os.path.join(addon_id, no_thing) not in zf.namelist():
-                        elem = ET.SubElement(metadata_elem, 'no' + os.path.splitext(no_thing)[0])
-                        elem.text = "true"
+    if cache_changed or old_cache:
+        write_cache(cache_path, cache)
 
-            elem = ET.SubElement(metadata_elem, 'size')
-            elem.text = str(os.path.getsize(archive))
+    def addon_data(key):
+        if prettify:
+            return serialize_addon(ET.fromstring(cache[key]['xml'].encode('utf-8'), parser), True)
+        return cache[key]['xml'].encode('utf-8')
 
-            elem = ET.SubElement(metadata_elem, 'path')
-            elem.text = str(os.path.relpath(archive, repo_dir))
+    def index_chunks():
+        yield XML_DECLARATION
+        if listed:
+            yield b'<addons>'
+            for key in listed:
+                yield addon_data(key)
+            yield b'\n</addons>' if prettify else b'</addons>'
+        else:
+            yield b'<addons/>'
+        if prettify:
+            yield b'\n'
 
-            addons.append(tree)
+    digest = hashlib.sha256()
+    for data in index_chunks():
+        digest.update(data)
+    digest = digest.hexdigest()
 
-    xml = ET.tostring(addons, encoding='utf-8', xml_declaration=True)
-    if prettify:
-        xml = minidom.parseString(xml).toprettyxml(encoding='utf-8', indent="  ")
+    old_digest = state.get('sha256')
+    if old_digest is None and os.path.exists(dest):
+        # published before its hash was recorded
+        old_digest = file_hash(dest)
+    no_change = digest == old_digest
 
-    no_change = False
-    try:
-        with open(dest, 'rb') as f:
-            no_change = (xml == f.read())
-    except IOError:
-        pass
+    # outputs that were enabled since the last run have to be written even if the content is the same
+    expected = [dest + '.' + fmt for fmt in formats]
+    expected += [path + '.' + name for path in [dest] + expected for name in checksums]
+    if not all(os.path.exists(path) for path in [dest] + expected):
+        no_change = False
 
     if no_change:
         logging.info("Contents not changed, not touching {}".format(dest))
     else:
         logging.info("Writing {}".format(dest))
-        with open(dest, 'wb') as f:
-            f.write(xml)
+        writer = IndexWriter(dest, formats, checksums)
+        try:
+            for data in index_chunks():
+                writer.write(data)
+        except BaseException:
+            writer.discard()
+            raise
+        writer.commit()
+        if deltas > 0:
+            publish_delta(repo_dir, dest, state, addons, (addon_data(key) for key in changed), deltas,
+                          formats, checksums)
 
-        with gzip.GzipFile(dest + ".gz", 'wb', compresslevel=9, mtime=0) as f:
-            f.write(xml)
+    if not no_change or state.get('sha256') != digest:
+        state['sha256'] = digest
+        write_cache(state_path, state)
 
     return not no_change
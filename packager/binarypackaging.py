@@ -21,12 +21,17 @@ import os
 import zipfile
 from collections import namedtuple
 from distutils.version import LooseVersion
-from distutils.dir_util import copy_tree
 from itertools import groupby
 from xml.etree import ElementTree as ET
 
+from packager import cache
+from packager import metrics
+from packager import textures
 from packager import utils
-from .utils import delete_companion_files, makedirs_ignore_errors, meets_version_requirements, pack_artifact
+from packager import zipwriter
+from .utils import companion_files, delete_companion_files, makedirs_ignore_errors, meets_version_requirements
+from .utils import pack_artifact
+from .utils import package_artifacts
 
 
 logger = logging.getLogger(__name__)
@@ -38,34 +43,107 @@ def split_version(path):
     return os.path.splitext(os.path.basename(path))[0].rsplit('-', 1)
 
 
-def collect_artifacts(binary_repos, min_versions):
-    for repo_path in binary_repos:
-        if not os.path.isdir(repo_path):
-            logger.debug("No such repo %s. Skipping.", repo_path)
-            continue
-        for addon_id in os.listdir(os.path.join(repo_path)):
-            if os.path.isdir(os.path.join(repo_path, addon_id)):
-                zips = [os.path.join(repo_path, addon_id, name)
-                        for name in os.listdir(os.path.join(repo_path, addon_id))
-                        if os.path.splitext(name)[1] == '.zip' and '-' in name]
+class ScanCache(object):
+    """
+    Directory listings and addon.xml metadata of the binary repos, kept between runs. Listings are reused
+    while the directory mtime is unchanged, metadata while the zip's size and mtime are.
+    """
+
+    def __init__(self):
+        self.data = cache.load('binary-scan')
+        self.data.setdefault('dirs', {})
+        self.data.setdefault('zips', {})
+        self.changed = False
+
+    def list_dir(self, path, select):
+        mtime = os.stat(path).st_mtime
+        entry = self.data['dirs'].get(path)
+        if entry is None or entry['mtime'] != mtime:
+            metrics.incr('binary_scan_cache_misses', kind='dir')
+            entry = {'mtime': mtime, 'entries': select(path)}
+            self.data['dirs'][path] = entry
+            self.changed = True
+            # forget metadata of zips that disappeared from this directory
+            for zip_path in list(self.data['zips']):
+                if os.path.dirname(zip_path) == path and os.path.basename(zip_path) not in entry['entries']:
+                    del self.data['zips'][zip_path]
+        return entry['entries']
+
+    def read_zip(self, path, read):
+        stat = os.stat(path)
+        entry = self.data['zips'].get(path)
+        if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+            metrics.incr('binary_scan_cache_misses', kind='zip')
+            entry = {'size': stat.st_size, 'mtime': stat.st_mtime, 'metadata': read(path)}
+            self.data['zips'][path] = entry
+            self.changed = True
+        return entry['metadata']
+
+    def save(self):
+        if self.changed:
+            cache.save('binary-scan', self.data)
+
+
+def list_addon_dirs(repo_path):
+    return [name for name in os.listdir(repo_path) if os.path.isdir(os.path.join(repo_path, name))]
+
+
+def list_zips(addon_dir):
+    """ Returns the zip files of an addon directory, newest version first. """
+    zips = [name for name in os.listdir(addon_dir) if os.path.splitext(name)[1] == '.zip' and '-' in name]
+    zips.sort(key=lambda _: LooseVersion(split_version(_)[1]), reverse=True)
+    return zips
+
+
+def read_zip_metadata(path):
+    """ Returns version and imports from addon.xml in a binary addon zip, or None if it cannot be read. """
+    addon_id = os.path.basename(os.path.dirname(path)).split('+')[0]
+    try:
+        with zipfile.ZipFile(path, 'r') as zf:
+            try:
+                tree = ET.fromstring(zf.read(os.path.join(addon_id, 'addon.xml')))
+                imports = [(elem.attrib['addon'], elem.attrib.get('version', '0.0.0'))
+                           for elem in tree.findall('./requires/import')]
+                return {'version': tree.attrib['version'], 'imports': imports}
+            except (ET.ParseError, KeyError, IndexError) as e:
+                logging.exception("Failed to read addon info from '%s'. Skipping" % path)
+    except zipfile.BadZipfile as e:
+        logging.exception("Zip file {} is corrupted".format(path))
+    return None
+
+
+def collect_artifacts(binary_repos, min_versions, addon_dirs=None):
+    """ Yields the newest artifact of each addon directory, or only of those named in `addon_dirs`. """
+    scan_cache = ScanCache()
+    try:
+        for repo_path in binary_repos:
+            if not os.path.isdir(repo_path):
+                logger.debug("No such repo %s. Skipping.", repo_path)
+                continue
+            if addon_dirs is None:
+                names = scan_cache.list_dir(repo_path, list_addon_dirs)
+            else:
+                names = addon_dirs
+            for addon_id in names:
+                addon_dir = os.path.join(repo_path, addon_id)
+                if not os.path.isdir(addon_dir):
+                    continue
+                if '+' not in addon_id:
+                    logger.warning("Binary addon directory '%s' has no platform suffix. Skipping", addon_dir)
+                    continue
+                zips = scan_cache.list_dir(addon_dir, list_zips)
                 if len(zips) > 0:
-                    zips.sort(key=lambda _: LooseVersion(split_version(_)[1]), reverse=True)
-                    try:
-                        with zipfile.ZipFile(zips[0], 'r') as zf:
-                            try:
-                                tree = ET.fromstring(zf.read(os.path.join(addon_id.split('+')[0], 'addon.xml')))
-                                version = tree.attrib['version'].encode('utf-8')
-
-                                imports = [(elem.attrib['addon'], LooseVersion(elem.attrib.get('version', '0.0.0')))
-                                           for elem in tree.findall('./requires/import')]
-                                if meets_version_requirements(imports, min_versions):
-                                    yield Artifact(addon_id.split('+')[0], version, zips[0], addon_id.split('+')[1])
-                            except (ET.ParseError, KeyError, IndexError) as e:
-                                logging.exception("Failed to read addon info from '%s'. Skipping" % zips[0])
-                                continue
-                    except zipfile.BadZipfile as e:
-                        logging.exception("Zip file {} is corrupted".format(zips[0]))
+                    path = os.path.join(addon_dir, zips[0])
+                    metadata = scan_cache.read_zip(path, read_zip_metadata)
+                    if metadata is None:
+                        logger.debug("Skipping '%s', its addon.xml could not be read", path)
                         continue
+                    version = metadata['version'].encode('utf-8')
+                    imports = [(addon, LooseVersion(imported_version)) for addon, imported_version in metadata['imports']]
+                    if meets_version_requirements(imports, min_versions):
+                        yield Artifact(addon_id.split('+')[0], version, path, addon_id.split('+')[1])
+    finally:
+        scan_cache.save()
 
 
 def filter_latest_version(artifacts):
@@ -79,34 +157,70 @@ def filter_latest_version(artifacts):
         yield versions[0]
 
 
-def write_artifact(artifact, outdir):
-    # Reads artifact data from git and writes a zip file (and companion files) to `outdir`
-    with utils.tempdir() as unpack_dir:
-        with zipfile.ZipFile(artifact.location, 'r') as zf:
-            zf.extractall(unpack_dir)
-
-        with utils.tempdir() as package_dir:
-            pack_artifact(artifact, os.path.join(unpack_dir, artifact.addon_id), package_dir)
-            delete_companion_files(outdir)
-            copy_tree(package_dir, outdir)
-
-
-def update_changed_artifacts(binary_repos, min_versions, outdir):
-    """ Returns a tuple with number of new and a list of all artifacts. """
+def repack_artifact(artifact, zf, xml, dst_dir):
+    """
+    Writes the zip file (and companion files) of `artifact` to `dst_dir` by copying the stored and deflated
+    members of the source zip as they are. Only the companion files and members compressed with other
+    methods are decompressed.
+    """
+    prefix = artifact.addon_id + '/'
+    for src, dst, required in companion_files(artifact, xml):
+        try:
+            data = zf.read(prefix + src)
+        except KeyError:
+            if required:
+                raise
+            continue
+        makedirs_ignore_errors(os.path.join(dst_dir, os.path.dirname(dst)))
+        with open(os.path.join(dst_dir, dst), 'wb') as f:
+            f.write(data)
 
-    artifacts = list(collect_artifacts(binary_repos, min_versions))
-    artifacts = list(filter_latest_version(artifacts))
+    dest_file = os.path.join(dst_dir, "%s-%s.zip" % (artifact.addon_id, artifact.version))
+    with zipfile.ZipFile(dest_file, 'w', zipfile.ZIP_DEFLATED) as out:
+        members = [info for info in zf.infolist() if info.filename.startswith(prefix) and not info.filename.endswith('/')]
+        if zipwriter.reproducible:
+            members.sort(key=lambda info: info.filename)
+        for info in members:
+            zipwriter.copy_member(zf, info, out)
 
-    added = [a for a in artifacts if not os.path.exists(
-        os.path.join(outdir, "%s+%s" % (a.addon_id, a.platform), "%s-%s.zip" % (a.addon_id, a.version)))]
 
+def write_artifact(artifact, outdir):
+    # Reads artifact data from the binary zip and writes a zip file (and companion files) to `outdir`
+    with utils.tempdir() as package_dir:
+        with zipfile.ZipFile(artifact.location, 'r') as zf:
+            xml = ET.ElementTree(ET.fromstring(zf.read(artifact.addon_id + '/addon.xml')))
+            if textures.texture_dirs(xml):
+                # TexturePacker needs the files on disk
+                with utils.tempdir() as unpack_dir:
+                    zf.extractall(unpack_dir)
+                    pack_artifact(artifact, os.path.join(unpack_dir, artifact.addon_id), package_dir)
+            else:
+                repack_artifact(artifact, zf, xml, package_dir)
+
+        delete_companion_files(outdir)
+        utils.link_tree(package_dir, outdir)
+
+
+def update_changed_artifacts(binary_repos, min_versions, outdir, catalog, addon_dirs=None):
+    """
+    Returns a tuple with number of new and a list of all artifacts. With `addon_dirs` given, only those
+    addon directories of the repos are looked at.
+    """
+    target = os.path.basename(outdir)
+    with metrics.phase('collect_binary', target=target):
+        artifacts = list(collect_artifacts(binary_repos, min_versions, addon_dirs))
+        artifacts = list(filter_latest_version(artifacts))
+
+    added = [a for a in artifacts if not catalog.contains(
+        "%s+%s" % (a.addon_id, a.platform), "%s-%s.zip" % (a.addon_id, a.version))]
+
+    jobs = []
     for artifact in added:
         logger.info("New artifact %s+%s version %s", artifact.addon_id, artifact.platform, artifact.version)
         dest = os.path.join(outdir, "%s+%s" % (artifact.addon_id, artifact.platform))
         makedirs_ignore_errors(dest)
-        try:
-            write_artifact(artifact, dest)
-        except Exception as ex:
-            logger.error("Failed to package %s:", artifact, exc_info=1)
+        jobs.append(("%s+%s-%s" % (artifact.addon_id, artifact.platform, artifact.version), artifact, dest))
+    with metrics.phase('package_binary', target=target):
+        package_artifacts(write_artifact, jobs, catalog)
 
     return len(added), ['%s+%s' % (a.addon_id, a.platform) for a in artifacts]
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+#
+#     Copyright (C) 2015 Team Kodi
+#     http://kodi.tv
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Directory for state kept between runs. Caching is disabled when not set.
+cache_dir = None
+# State loaded or saved by this process, so that long-running processes do not read it back from disk
+_loaded = {}
+
+
+def path(name):
+    return os.path.join(cache_dir, name)
+
+
+def load(name):
+    """ Returns the data stored under `name`, or an empty dict if there is none. """
+    if cache_dir is None:
+        return {}
+    if name not in _loaded:
+        try:
+            with open(path(name + '.json'), 'r') as f:
+                _loaded[name] = json.load(f)
+        except (IOError, ValueError):
+            _loaded[name] = {}
+    return _loaded[name]
+
+
+def save(name, data):
+    if cache_dir is None:
+        return
+    _loaded[name] = data
+    try:
+        os.makedirs(cache_dir)
+    except OSError:
+        pass
+    filename = path(name + '.json')
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(data, f)
+    os.rename(filename + '.tmp', filename)
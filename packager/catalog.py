@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+#
+#     Copyright (C) 2015 Team Kodi
+#     http://kodi.tv
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import os
+import sqlite3
+import stat
+from distutils.version import LooseVersion
+from packager.store import file_hash
+
+logger = logging.getLogger(__name__)
+
+FILENAME = '.catalog.sqlite'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS artifacts (
+    artifact_dir TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    addon_id TEXT NOT NULL,
+    version TEXT NOT NULL,
+    version_key TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    PRIMARY KEY (artifact_dir, filename)
+);
+CREATE TABLE IF NOT EXISTS dirs (
+    artifact_dir TEXT PRIMARY KEY,
+    mtime REAL NOT NULL
+);
+'''
+
+
+def version_key(version):
+    """
+    Returns a string that sorts like LooseVersion(`version`), so that versions can be ordered by sqlite.
+    Numbers sort before words, like they do when python 2 compares LooseVersions.
+    """
+    parts = []
+    for part in LooseVersion(version).version:
+        if isinstance(part, int):
+            parts.append('0%012d' % part)
+        else:
+            parts.append('1' + part)
+    return '\x01'.join(parts)
+
+
+def split_filename(filename):
+    """ Returns (addon_id, version) of a zip named addon_id-version.zip, or None. """
+    name, ext = os.path.splitext(filename)
+    if ext != '.zip' or '-' not in name:
+        return None
+    return tuple(name.rsplit('-', 1))
+
+
+def exists(target_dir):
+    return os.path.exists(os.path.join(target_dir, FILENAME))
+
+
+def latest_archives(target_dir, accept=None):
+    """
+    Returns the paths of the newest zip of each artifact in `target_dir`, according to its catalog. Only zips
+    whose filename `accept` returns true for are considered if it is given.
+    """
+    catalog = Catalog(target_dir)
+    try:
+        return [os.path.join(target_dir, path) for path in catalog.latest(accept)]
+    finally:
+        catalog.close()
+
+
+class Catalog(object):
+    """
+    The artifact zips of a target directory, kept in a sqlite database inside it so that the tree does not
+    have to be listed to find them. A missing catalog is built by scanning the directory. Changes made in a
+    `with catalog:` block are committed together.
+    """
+
+    def __init__(self, target_dir):
+        self.target_dir = target_dir
+        bootstrap = not exists(target_dir)
+        self.db = sqlite3.connect(os.path.join(target_dir, FILENAME))
+        self.db.executescript(SCHEMA)
+        if bootstrap:
+            with self:
+                self.rebuild()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.db.commit()
+        else:
+            self.db.rollback()
+
+    def close(self):
+        self.db.close()
+
+    def rebuild(self):
+        """ Replaces the catalog with the zips found on disk. """
+        logger.info("Building catalog of %s", self.target_dir)
+        self.db.execute('DELETE FROM artifacts')
+        self.db.execute('DELETE FROM dirs')
+        for artifact_dir, mtime in self.dirs_on_disk().items():
+            self.scan(artifact_dir, mtime)
+
+    def reconcile(self):
+        """
+        Brings the catalog in line with the target directory, which differs when a run was interrupted or the
+        tree was changed by hand. Artifact directories whose mtime changed since they were last scanned are
+        listed again. Returns the artifact directories on disk.
+        """
+        on_disk = self.dirs_on_disk()
+        known = dict(self.db.execute('SELECT artifact_dir, mtime FROM dirs'))
+        gone = (set(known) | self.artifact_dirs()) - set(on_disk)
+        changed = [artifact_dir for artifact_dir, mtime in on_disk.items() if known.get(artifact_dir) != mtime]
+        if gone or changed:
+            logger.debug("Updating catalog of %s: %d directories changed, %d gone",
+                         self.target_dir, len(changed), len(gone))
+            with self:
+                for artifact_dir in gone:
+                    self.remove(artifact_dir)
+                for artifact_dir in changed:
+                    self.scan(artifact_dir, on_disk[artifact_dir])
+        return set(on_disk)
+
+    def dirs_on_disk(self):
+        """ Returns the mtime of each artifact directory of the target directory. """
+        dirs = {}
+        for name in os.listdir(self.target_dir):
+            if name.startswith('.'):
+                continue
+            st = os.stat(os.path.join(self.target_dir, name))
+            if stat.S_ISDIR(st.st_mode):
+                dirs[name] = st.st_mtime
+        return dirs
+
+    def scan(self, artifact_dir, mtime):
+        """
+        Records the zips found in `artifact_dir`, listed when it had modification time `mtime`, and forgets
+        the recorded ones that are gone. Zips that are already recorded are not hashed again.
+        """
+        found = set(filename for filename in os.listdir(os.path.join(self.target_dir, artifact_dir))
+                    if split_filename(filename))
+        recorded = set(self.versions(artifact_dir))
+        for filename in recorded - found:
+            self.remove(artifact_dir, filename)
+        for filename in found - recorded:
+            self.add(artifact_dir, filename)
+        self.db.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?)', (artifact_dir, mtime))
+
+    def add(self, artifact_dir, filename):
+        """ Records zip `filename` that was written to `artifact_dir`. """
+        addon_id, version = split_filename(filename)
+        path = os.path.join(self.target_dir, artifact_dir, filename)
+        self.db.execute('INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?, ?, ?, ?, ?)',
+                        (artifact_dir, filename, addon_id, version, version_key(version),
+                         os.path.getsize(path), file_hash(path)))
+
+    def remove(self, artifact_dir, filename=None):
+        """ Forgets zip `filename` of `artifact_dir`, or the whole directory if no filename is given. """
+        if filename is None:
+            self.db.execute('DELETE FROM artifacts WHERE artifact_dir = ?', (artifact_dir,))
+            self.db.execute('DELETE FROM dirs WHERE artifact_dir = ?', (artifact_dir,))
+        else:
+            self.db.execute('DELETE FROM artifacts WHERE artifact_dir = ? AND filename = ?',
+                            (artifact_dir, filename))
+
+    def forget_missing(self, artifact_dir, filename):
+        """ Returns whether recorded zip `filename` of `artifact_dir` is gone from disk, forgetting it if so. """
+        if os.path.exists(os.path.join(self.target_dir, artifact_dir, filename)):
+            return False
+        logger.info("%s was removed from %s behind the catalog's back", filename, self.target_dir)
+        with self:
+            self.remove(artifact_dir, filename)
+        return True
+
+    def contains(self, artifact_dir, filename):
+        """ Returns whether zip `filename` of `artifact_dir` is recorded and still on disk. """
+        recorded = self.db.execute('SELECT 1 FROM artifacts WHERE artifact_dir = ? AND filename = ?',
+                                   (artifact_dir, filename)).fetchone() is not None
+        return recorded and not self.forget_missing(artifact_dir, filename)
+
+    def artifact_dirs(self):
+        return set(row[0] for row in self.db.execute('SELECT DISTINCT artifact_dir FROM artifacts'))
+
+    def versions(self, artifact_dir):
+        """ Returns the zip filenames of `artifact_dir`, newest version first. """
+        return [row[0] for row in self.db.execute(
+            'SELECT filename FROM artifacts WHERE artifact_dir = ? ORDER BY version_key DESC', (artifact_dir,))]
+
+    def latest(self, accept=None):
+        """
+        Returns the paths, relative to the target directory, of the newest zip of each artifact, skipping
+        the zips whose filename `accept` returns false for. Zips that are gone from disk are forgotten.
+        """
+        paths = {}
+        rows = self.db.execute('SELECT artifact_dir, filename FROM artifacts ORDER BY artifact_dir, version_key DESC')
+        for artifact_dir, filename in rows.fetchall():
+            if artifact_dir in paths or (accept is not None and not accept(filename)):
+                continue
+            if not self.forget_missing(artifact_dir, filename):
+                paths[artifact_dir] = os.path.join(artifact_dir, filename)
+        return [paths[artifact_dir] for artifact_dir in sorted(paths)]
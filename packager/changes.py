@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+#
+#     Copyright (C) 2015 Team Kodi
+#     http://kodi.tv
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+
+# Paths created, modified and deleted by this process since the last reset(). Deleted directories end with
+# a path separator.
+_created = set()
+_modified = set()
+_deleted = set()
+
+
+def reset():
+    _created.clear()
+    _modified.clear()
+    _deleted.clear()
+
+
+def written(path):
+    """ Records that `path` is about to be written. Must be called before the file is (over)written. """
+    if path in _created or path in _modified:
+        return
+    if path in _deleted or os.path.exists(path):
+        _deleted.discard(path)
+        _modified.add(path)
+    else:
+        _created.add(path)
+
+
+def _forget_under(directory):
+    for recorded in (_created, _modified, _deleted):
+        for name in [name for name in recorded if name.startswith(directory)]:
+            recorded.remove(name)
+
+
+def deleted(path):
+    """ Records that file or directory `path` is about to be deleted. """
+    if os.path.isdir(path):
+        path = os.path.join(path, '')
+        _forget_under(path)
+        _deleted.add(path)
+    elif path in _created:
+        _created.remove(path)
+    else:
+        _modified.discard(path)
+        _deleted.add(path)
+
+
+def collect():
+    """ Returns the recorded changes in a form that can be passed between processes and to merge(). """
+    return {'created': sorted(_created), 'modified': sorted(_modified), 'deleted': sorted(_deleted)}
+
+
+def merge(changes):
+    """ Adds changes recorded by another process, in the order they happened after the ones recorded here. """
+    for path in changes['deleted']:
+        if path.endswith(os.sep):
+            _forget_under(path)
+        if path in _created:
+            _created.remove(path)
+            continue
+        _modified.discard(path)
+        _deleted.add(path)
+    for path in changes['created'] + changes['modified']:
+        if path in _created:
+            continue
+        if path in _deleted:
+            _deleted.remove(path)
+            _modified.add(path)
+        elif path not in _modified:
+            (_created if path in changes['created'] else _modified).add(path)
+
+
+def save(filename, root, append=False):
+    """
+    Writes the recorded changes to `filename` as JSON, with paths relative to `root`. With `append`, the
+    changes are merged into the ones already in the file.
+    """
+    if append:
+        try:
+            with open(filename, 'r') as f:
+                previous = json.load(f)
+            current = collect()
+            reset()
+            merge(dict((key, [os.path.join(root, path) for path in paths]) for key, paths in previous.items()))
+            merge(current)
+        except (IOError, ValueError):
+            pass
+
+    relative = dict((key, [os.path.relpath(path, root) + ('/' if path.endswith(os.sep) else '') for path in paths])
+                    for key, paths in collect().items())
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(relative, f, indent=1)
+    os.rename(filename + '.tmp', filename)
@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+#
+#     Copyright (C) 2015 Team Kodi
+#     http://kodi.tv
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import binascii
+import logging
+import os
+import subprocess
+import sys
+from collections import namedtuple
+
+from packager import metrics
+
+logger = logging.getLogger(__name__)
+
+
+TreeEntry = namedtuple('TreeEntry', ['mode', 'type', 'sha', 'name'])
+
+# what git fetch reports when a refspec names a ref the remote does not have
+_MISSING_REMOTE_REF = b"couldn't find remote ref"
+
+
+def _native(data):
+    return data if str is bytes else data.decode('utf-8')
+
+
+class GitBackend(object):
+    """
+    Read access to a git repository. Revisions are anything `git rev-parse` understands. Missing objects
+    and paths raise KeyError.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def is_bare(self):
+        raise NotImplementedError
+
+    def resolve(self, rev):
+        """ Returns the SHA of the commit `rev` points to, or None if it does not exist. """
+        raise NotImplementedError
+
+    def commit_time(self, rev):
+        """ Returns the committer timestamp of commit `rev`. """
+        raise NotImplementedError
+
+    def ls_tree(self, treeish):
+        """ Returns the TreeEntry list of the top level of `treeish`. """
+        raise NotImplementedError
+
+    def read_file(self, treeish, path):
+        """ Returns the content of file `path` in `treeish`. """
+        raise NotImplementedError
+
+    def read_blob(self, sha):
+        raise NotImplementedError
+
+    def remote_branches(self, remote):
+        """ Returns the names of the branches `remote` has. """
+        raise NotImplementedError
+
+    def fetch(self, remote, refspecs=None):
+        """ Fetches `refspecs` from `remote`. Raises KeyError if the remote lacks one of their refs. """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+def _parse_heads(output):
+    """ Returns the branch names in the output of `git ls-remote --heads`. """
+    return set(_native(line.split(b'\t', 1)[1])[len('refs/heads/'):] for line in output.splitlines() if line)
+
+
+class CatFileBackend(GitBackend):
+    """
+    Reads objects through one long-lived `git cat-file --batch` and `--batch-check` process per repository,
+    so that bulk tree and blob reads do not spawn a process each.
+    """
+
+    def __init__(self, path):
+        super(CatFileBackend, self).__init__(path)
+        self._batch = None
+        self._batch_check = None
+
+    def _start(self, mode):
+        return subprocess.Popen(['git', 'cat-file', mode], cwd=self.path,
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def _query(self, process, rev):
+        metrics.incr('git_object_reads', backend='cat-file')
+        process.stdin.write(rev.encode('utf-8') + b'\n')
+        process.stdin.flush()
+        header = process.stdout.readline().split()
+        if len(header) != 3 or header[-1] in (b'missing', b'ambiguous'):
+            # "<rev> missing" or "<rev> ambiguous", where <rev> may contain spaces
+            raise KeyError(rev)
+        return _native(header[0]), _native(header[1]), int(header[2])
+
+    def info(self, rev):
+        """ Returns (sha, type, size) of object `rev`. """
+        if self._batch_check is None:
+            self._batch_check = self._start('--batch-check')
+        return self._query(self._batch_check, rev)
+
+    def read(self, rev):
+        """ Returns (sha, type, data) of object `rev`. """
+        if self._batch is None:
+            self._batch = self._start('--batch')
+        sha, type, size = self._query(self._batch, rev)
+        data = self._batch.stdout.read(size)
+        self._batch.stdout.read(1)  # trailing newline
+        return sha, type, data
+
+    def is_bare(self):
+        output = subprocess.check_output(['git', 'rev-parse', '--is-bare-repository'], cwd=self.path)
+        return output.strip() == b'true'
+
+    def resolve(self, rev):
+        try:
+            return self.info(rev + '^{commit}')[0]
+        except KeyError:
+            return None
+
+    def commit_time(self, rev):
+        for line in self.read(rev + '^{commit}')[2].split(b'\n'):
+            if line.startswith(b'committer '):
+                return int(line.rsplit(b' ', 2)[1])
+            if not line:
+                break
+        raise KeyError(rev)
+
+    def ls_tree(self, treeish):
+        data = self.read(treeish + '^{tree}')[2]
+        entries = []
+        pos = 0
+        while pos < len(data):
+            space = data.index(b' ', pos)
+            nul = data.index(b'\0', space)
+            mode = int(data[pos:space], 8)
+            sha = _native(binascii.hexlify(data[nul + 1:nul + 21]))
+            if mode == 0o40000:
+                type = 'tree'
+            elif mode == 0o160000:
+                type = 'commit'
+            else:
+                type = 'blob'
+            entries.append(TreeEntry(mode, type, sha, _native(data[space + 1:nul])))
+            pos = nul + 21
+        return entries
+
+    def read_file(self, treeish, path):
+        sha, type, data = self.read(treeish + ':' + path)
+        if type != 'blob':
+            raise KeyError(path)
+        return data
+
+    def read_blob(self, sha):
+        return self.read(sha)[2]
+
+    def remote_branches(self, remote):
+        return _parse_heads(subprocess.check_output(['git', 'ls-remote', '--heads', remote], cwd=self.path))
+
+    def fetch(self, remote, refspecs=None):
+        command = ['git', 'fetch', '--quiet', remote] + list(refspecs or [])
+        process = subprocess.Popen(command, cwd=self.path, stderr=subprocess.PIPE)
+        _, stderr = process.communicate()
+        # the running cat-file processes may not see the fetched refs and packs
+        self.close()
+        if process.returncode != 0:
+            if _MISSING_REMOTE_REF in stderr:
+                raise KeyError(_native(stderr).strip())
+            sys.stderr.write(_native(stderr))
+            raise subprocess.CalledProcessError(process.returncode, command)
+
+    def close(self):
+        for process in (self._batch, self._batch_check):
+            if process is not None:
+                process.stdin.close()
+                process.wait()
+        self._batch = None
+        self._batch_check = None
+
+
+class GitPythonBackend(GitBackend):
+    """ Reads objects through GitPython. """
+
+    def __init__(self, path):
+        import git
+        super(GitPythonBackend, self).__init__(path)
+        self.repo = git.Repo(path)
+
+    def is_bare(self):
+        return self.repo.bare
+
+    def resolve(self, rev):
+        import git
+        try:
+            return self.repo.rev_parse(rev + '^{commit}').hexsha
+        except (git.BadName, KeyError, ValueError):
+            return None
+
+    def commit_time(self, rev):
+        return self.repo.commit(rev).committed_date
+
+    def _tree(self, treeish):
+        import git
+        metrics.incr('git_object_reads', backend='gitpython')
+        try:
+            return self.repo.rev_parse(treeish + '^{tree}')
+        except (git.BadName, ValueError):
+            raise KeyError(treeish)
+
+    def ls_tree(self, treeish):
+        return [TreeEntry(obj.mode, obj.type, obj.hexsha, obj.name) for obj in self._tree(treeish)]
+
+    def read_file(self, treeish, path):
+        obj = self._tree(treeish)[path]
+        if obj.type != 'blob':
+            raise KeyError(path)
+        return obj.data_stream.read()
+
+    def read_blob(self, sha):
+        metrics.incr('git_object_reads', backend='gitpython')
+        return self.repo.odb.stream(binascii.unhexlify(sha)).read()
+
+    def remote_branches(self, remote):
+        return _parse_heads(self.repo.git.ls_remote('--heads', remote).encode('utf-8'))
+
+    def fetch(self, remote, refspecs=None):
+        import git
+        try:
+            self.repo.remotes[remote].fetch(refspecs)
+        except git.GitCommandError as e:
+            if _native(_MISSING_REMOTE_REF) in str(e):
+                raise KeyError(str(e))
+            raise
+
+
+backends = {
+    'cat-file': CatFileBackend,
+    'gitpython': GitPythonBackend,
+}
+backend_name = 'cat-file'
+_open_backends = {}
+
+
+def get_backend(path):
+    """
+    Returns the backend for the repository at `path`, reusing the one opened earlier by this process.
+    Worker processes get their own instance so they never share a cat-file pipe with their parent.
+    """
+    key = (os.getpid(), path)
+    if key not in _open_backends:
+        _open_backends[key] = backends[backend_name](path)
+    return _open_backends[key]
+
+
+def close_all():
+    for key, backend in list(_open_backends.items()):
+        if key[0] == os.getpid():
+            backend.close()
+            del _open_backends[key]
@@ -16,51 +16,102 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import git
 import logging
 import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import time
 import zipfile
 from collections import namedtuple
 from distutils.version import LooseVersion
-from distutils.dir_util import copy_tree
-from io import BytesIO
 from itertools import groupby
 from xml.etree import ElementTree as ET
 
+from packager import cache
+from packager import gitbackend
+from packager import metrics
+from packager import textures
 from packager import utils
-from .utils import delete_companion_files, makedirs_ignore_errors, meets_version_requirements, pack_artifact
+from packager import zipwriter
+from .utils import companion_files, delete_companion_files, makedirs_ignore_errors, meets_version_requirements
+from .utils import package_artifacts
 
 logger = logging.getLogger(__name__)
 
 
-Artifact = namedtuple('Artifact', ['addon_id', 'version', 'git_repo', 'treeish'])
+Artifact = namedtuple('Artifact', ['addon_id', 'version', 'git_repo', 'treeish', 'tree_sha'])
+
+# When set, packaged artifacts are kept in this directory keyed by their git tree, so that targets
+# resolving an addon to the same tree reuse the first build instead of packaging it again.
+build_cache_dir = None
+
+
+def read_addon_metadata(backend, directory):
+    """ Parses addon.xml of an addon directory into the metadata stored between runs. """
+    tree = ET.fromstring(backend.read_file(directory.sha, 'addon.xml'))
+    imports = [(elem.attrib['addon'], elem.attrib.get('version', '0.0.0'))
+               for elem in tree.findall('./requires/import')]
+    return {'tree': directory.sha, 'version': tree.attrib['version'], 'imports': imports}
+
+
+def read_ref_metadata(backend, commit, previous):
+    """
+    Returns the metadata of all addons in `commit`. Addon directories whose tree is unchanged since the
+    commit recorded in `previous` reuse its metadata instead of reading addon.xml again.
+    """
+    old_addons = previous.get('addons', {})
+    addons = {}
+    for directory in backend.ls_tree(commit):
+        # avoid processing directories starting with a . (e.g. .github)
+        if directory.type != 'tree' or directory.name.startswith("."):
+            continue
+        artifact_id = directory.name
+        entry = old_addons.get(artifact_id)
+        if entry is None or entry['tree'] != directory.sha:
+            metrics.incr('addon_metadata_reads')
+            try:
+                entry = read_addon_metadata(backend, directory)
+            except (ET.ParseError, KeyError, IndexError) as e:
+                logger.exception("Failed to read addon data from directory '%s'" % artifact_id)
+                entry = {'tree': directory.sha, 'version': None, 'imports': []}
+        addons[artifact_id] = entry
+    return addons
 
 
 def collect_artifacts(git_repos, refs, min_versions):
+    state = cache.load('git-collect')
+    changed = False
     for repo_path in git_repos:
-        repo = git.Repo(repo_path)
-        if repo.bare:
+        backend = gitbackend.get_backend(repo_path)
+        if backend.is_bare():
             logger.warning("Repo %s is bare, Skipping", repo_path)
             continue
         for ref in refs:
-            if ref not in repo.refs:
+            commit = backend.resolve(ref)
+            if commit is None:
                 logger.debug("No such ref %s in repo %s. Skipping.", ref, repo_path)
                 continue
-            for directory in repo.refs[ref].commit.tree.trees:
-                # avoid processing directories starting with a . (e.g. .github)
-                if not directory.name.encode('utf-8').startswith("."):
-                    try:
-                        addon_xml = directory['addon.xml'].data_stream.read()
-                        tree = ET.fromstring(addon_xml)
-                        artifact_id = directory.name.encode('utf-8')
-                        version = tree.attrib['version'].encode('utf-8')
-
-                        imports = [(elem.attrib['addon'], LooseVersion(elem.attrib.get('version', '0.0.0')))
-                                for elem in tree.findall('./requires/import')]
-                        if meets_version_requirements(imports, min_versions):
-                            yield Artifact(artifact_id, version, repo_path, ref + ":" + artifact_id)
-                    except (ET.ParseError, KeyError, IndexError) as e:
-                        logger.exception("Failed to read addon data from directory '%s'" % directory.name.encode('utf-8'))
+            key = "%s %s" % (repo_path, ref)
+            previous = state.get(key, {})
+            if previous.get('commit') != commit:
+                state[key] = {'commit': commit, 'addons': read_ref_metadata(backend, commit, previous)}
+                changed = True
+            else:
+                metrics.incr('refs_unchanged')
+
+            for artifact_id, entry in sorted(state[key]['addons'].items()):
+                if entry['version'] is None:
+                    logger.debug("Skipping '%s', its addon.xml could not be read", artifact_id)
+                    continue
+                version = entry['version'].encode('utf-8')
+                imports = [(addon, LooseVersion(imported_version)) for addon, imported_version in entry['imports']]
+                if meets_version_requirements(imports, min_versions):
+                    yield Artifact(artifact_id, version, repo_path, ref + ":" + artifact_id, entry['tree'])
+
+    if changed:
+        cache.save('git-collect', state)
 
 
 def filter_latest_version(artifacts):
@@ -74,36 +125,152 @@ def filter_latest_version(artifacts):
         yield versions[0]
 
 
+def iter_blobs(backend, tree, prefix=''):
+    """ Yields (path, TreeEntry) for all files in `tree`, recursively. """
+    for entry in backend.ls_tree(tree):
+        if entry.type == 'blob':
+            yield prefix + entry.name, entry
+        elif entry.type == 'tree':
+            for path, blob in iter_blobs(backend, entry.sha, prefix + entry.name + '/'):
+                yield path, blob
+
+
+def exported_paths(artifact):
+    """
+    Returns the paths of the files `git archive` puts in an archive of the addon tree, which leaves out
+    those with the export-ignore attribute.
+    """
+    process = subprocess.Popen(['git', 'archive', '--format=tar', artifact.tree_sha], cwd=artifact.git_repo,
+                               stdout=subprocess.PIPE)
+    try:
+        tar = tarfile.open(fileobj=process.stdout, mode='r|')
+        paths = set(member.name for member in tar if not member.isdir())
+        tar.close()
+    finally:
+        process.stdout.close()
+        if process.wait() != 0:
+            raise subprocess.CalledProcessError(process.returncode, 'git archive')
+    return paths
+
+
+def write_file(data, path):
+    makedirs_ignore_errors(os.path.dirname(path))
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def build_artifact(artifact, package_dir):
+    """
+    Reads artifact data from git and writes a zip file (and companion files) to `package_dir`. Files are
+    streamed from the object store into the zip one at a time; only the directories TexturePacker works
+    on are written to disk.
+    """
+    backend = gitbackend.get_backend(artifact.git_repo)
+    tree = artifact.tree_sha
+    xml = ET.ElementTree(ET.fromstring(backend.read_file(tree, 'addon.xml')))
+    texture_dirs = textures.texture_dirs(xml)
+    date_time = time.localtime(backend.commit_time(artifact.treeish.split(':', 1)[0]))[:6]
+
+    for src, dst, required in companion_files(artifact, xml):
+        try:
+            data = backend.read_file(tree, src)
+        except KeyError:
+            if required:
+                raise
+            continue
+        write_file(data, os.path.join(package_dir, dst))
+
+    dest_file = os.path.join(package_dir, "%s-%s.zip" % (artifact.addon_id, artifact.version))
+    with utils.tempdir() as texture_dir:
+        files = list(iter_blobs(backend, tree))
+        if any(os.path.basename(path) == '.gitattributes' for path, _ in files):
+            # honour export-ignore like the `git archive` this replaces, at the cost of reading the tree twice
+            exported = exported_paths(artifact)
+            files = [(path, blob) for path, blob in files if path in exported]
+
+        blobs = []
+        for path, blob in files:
+            if path.split('/', 1)[0] in texture_dirs:
+                write_file(backend.read_blob(blob.sha), os.path.join(texture_dir, path))
+            else:
+                blobs.append((artifact.addon_id + '/' + path, blob))
+        packed = []
+        if texture_dirs:
+            textures.pack_textures(xml, texture_dir)
+            packed = zipwriter.tree_files(texture_dir, artifact.addon_id + '/')
+
+        # the TexturePacker output follows the files from git, unless members have to be in sorted order
+        entries = [(arcname, blob, None) for arcname, blob in blobs]
+        entries += [(arcname, None, local_path) for arcname, local_path in packed]
+        if zipwriter.reproducible:
+            entries.sort(key=lambda _: _[0])
+
+        def members():
+            for arcname, blob, local_path in entries:
+                if blob is None:
+                    yield zipwriter.file_member(arcname, local_path)
+                    continue
+                info = zipfile.ZipInfo(arcname, date_time)
+                info.create_system = 3
+                info.external_attr = (blob.mode & 0xFFFF) << 16
+                yield zipwriter.normalized(info), backend.read_blob(blob.sha)
+
+        with zipfile.ZipFile(dest_file, 'w', zipfile.ZIP_DEFLATED) as zf:
+            zipwriter.write_members(zf, members())
+
+
+def cached_build(artifact):
+    """ Returns the build cache directory holding the packaged artifact, building it on a cache miss. """
+    cached_dir = os.path.join(build_cache_dir, "%s-%s" % (artifact.addon_id, artifact.tree_sha))
+    if os.path.isdir(cached_dir):
+        logger.debug("Reusing package of %s built from tree %s", artifact.addon_id, artifact.tree_sha)
+        metrics.incr('build_cache_hits')
+        return cached_dir
+
+    metrics.incr('build_cache_misses')
+    package_dir = tempfile.mkdtemp(dir=build_cache_dir)
+    try:
+        build_artifact(artifact, package_dir)
+        os.rename(package_dir, cached_dir)
+    except OSError:
+        # another worker finished the same tree first
+        if not os.path.isdir(cached_dir):
+            raise
+    finally:
+        shutil.rmtree(package_dir, ignore_errors=True)
+    return cached_dir
+
+
 def write_artifact(artifact, outdir):
-    """ Reads artifact data from git and writes a zip file (and companion files) to `outdir` """
-    repo = git.Repo(artifact.git_repo)
-    with utils.tempdir() as unpack_dir:
-        buffer = BytesIO()
-        repo.archive(buffer, artifact.treeish, format="zip")
-        with zipfile.ZipFile(buffer, 'r') as zf:
-            zf.extractall(unpack_dir)
+    """ Writes the zip file (and companion files) of `artifact` to `outdir` """
+    if build_cache_dir is not None:
+        package_dir = cached_build(artifact)
+        delete_companion_files(outdir)
+        utils.link_tree(package_dir, outdir)
+        return
 
-        with utils.tempdir() as package_dir:
-            pack_artifact(artifact, unpack_dir, package_dir)
-            delete_companion_files(outdir)
-            copy_tree(package_dir, outdir)
+    with utils.tempdir() as package_dir:
+        build_artifact(artifact, package_dir)
+        delete_companion_files(outdir)
+        utils.link_tree(package_dir, outdir)
 
 
-def update_changed_artifacts(git_repos, refs, min_versions, outdir):
+def update_changed_artifacts(git_repos, refs, min_versions, outdir, catalog):
     """ Returns a tuple with number of new and a list of all artifacts. """
-    artifacts = collect_artifacts(git_repos, refs, min_versions)
-    artifacts = list(filter_latest_version(artifacts))
+    target = os.path.basename(outdir)
+    with metrics.phase('collect', target=target):
+        artifacts = collect_artifacts(git_repos, refs, min_versions)
+        artifacts = list(filter_latest_version(artifacts))
 
-    added = [a for a in artifacts if not os.path.exists(
-        os.path.join(outdir, a.addon_id, "%s-%s.zip" % (a.addon_id, a.version)))]
+    added = [a for a in artifacts if not catalog.contains(a.addon_id, "%s-%s.zip" % (a.addon_id, a.version))]
 
+    jobs = []
     for artifact in added:
         logger.debug("New artifact %s version %s", artifact.addon_id, artifact.version)
         dest = os.path.join(outdir, artifact.addon_id)
         makedirs_ignore_errors(dest)
-        try:
-            write_artifact(artifact, dest)
-        except Exception as ex:
-            logger.error("Failed to package %s:", artifact, exc_info=1)
+        jobs.append(("%s-%s" % (artifact.addon_id, artifact.version), artifact, dest))
+    with metrics.phase('package', target=target):
+        package_artifacts(write_artifact, jobs, catalog)
 
     return len(added), [_.addon_id for _ in artifacts]
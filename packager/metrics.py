@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+#
+#     Copyright (C) 2015 Team Kodi
+#     http://kodi.tv
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+PROMETHEUS_PREFIX = 'repository_generator_'
+
+# Counters of this process since the last reset(), keyed by (name, sorted label items)
+_counters = {}
+# Per artifact records, only exported to the JSON report
+_artifacts = []
+_lock = threading.Lock()
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def incr(name, value=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def value(name, **labels):
+    return _counters.get(_key(name, labels), 0)
+
+
+@contextlib.contextmanager
+def timed(name, **labels):
+    """ Adds the time spent in the block to counter `<name>_seconds`. """
+    start = time.time()
+    try:
+        yield
+    finally:
+        incr(name + '_seconds', time.time() - start, **labels)
+
+
+def phase(name, **labels):
+    return timed('phase', phase=name, **labels)
+
+
+def record_artifact(**fields):
+    with _lock:
+        _artifacts.append(fields)
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        del _artifacts[:]
+
+
+def collect():
+    """ Returns the recorded metrics in a form that can be passed between processes and to merge(). """
+    with _lock:
+        return {'counters': [[name, dict(labels), count] for (name, labels), count in _counters.items()],
+                'artifacts': list(_artifacts)}
+
+
+def merge(metrics):
+    for name, labels, count in metrics['counters']:
+        incr(name, count, **labels)
+    with _lock:
+        _artifacts.extend(metrics['artifacts'])
+
+
+def _write_atomic(filename, content):
+    with open(filename + '.tmp', 'w') as f:
+        f.write(content)
+    os.rename(filename + '.tmp', filename)
+
+
+def write_json(filename, **extra):
+    report = dict(extra)
+    report.update(collect())
+    report['counters'].sort(key=lambda _: (_[0], sorted(_[1].items())))
+    _write_atomic(filename, json.dumps(report, indent=1, sort_keys=True))
+
+
+def _escape(label_value):
+    return str(label_value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def write_prometheus(filename, **gauges):
+    """ Writes the counters, and `gauges` without labels, in the node exporter textfile collector format. """
+    metrics = {}
+    for name, labels, count in collect()['counters']:
+        metrics.setdefault(name, []).append((labels, count))
+    for name, count in gauges.items():
+        metrics.setdefault(name, []).append(({}, count))
+
+    lines = []
+    for name in sorted(metrics):
+        lines.append('# TYPE %s%s gauge' % (PROMETHEUS_PREFIX, name))
+        for labels, count in sorted(metrics[name], key=lambda _: sorted(_[0].items())):
+            label_text = ','.join('%s="%s"' % (key, _escape(label_value)) for key, label_value in sorted(labels.items()))
+            lines.append('%s%s%s %s' % (PROMETHEUS_PREFIX, name, '{%s}' % label_text if label_text else '', repr(float(count))))
+    _write_atomic(filename, '\n'.join(lines) + '\n')
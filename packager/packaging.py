@@ -19,9 +19,11 @@
 import os
 import shutil
 import logging
-from distutils.version import LooseVersion
 from packager import binarypackaging
+from packager import catalog
+from packager import changes
 from packager import gitpackaging
+from packager import metrics
 
 logger = logging.getLogger(__name__)
 
@@ -29,45 +31,63 @@ logger = logging.getLogger(__name__)
 def update_changed_artifacts(git_repos, refs, binary_repos, min_versions, outdir):
     """ Returns a tuple with number of new and deleted artifacts. """
 
-    current = set([name for name in os.listdir(outdir)
-                   if os.path.isdir(os.path.join(outdir, name)) and not name.startswith('.')])
+    artifact_catalog = catalog.Catalog(outdir)
+    try:
+        # also picks up directories left behind by interrupted runs, so that they are removed
+        current = artifact_catalog.reconcile()
 
-    added, artifacts = gitpackaging.update_changed_artifacts(git_repos, refs, min_versions, outdir)
+        added, artifacts = gitpackaging.update_changed_artifacts(
+            git_repos, refs, min_versions, outdir, artifact_catalog)
 
-    addedBinary, artifactsBinary = binarypackaging.update_changed_artifacts(binary_repos, min_versions, outdir)
-    added += addedBinary
-    artifacts += artifactsBinary
+        addedBinary, artifactsBinary = binarypackaging.update_changed_artifacts(
+            binary_repos, min_versions, outdir, artifact_catalog)
+        added += addedBinary
+        artifacts += artifactsBinary
 
-    removed = current - set(artifacts)
-    for artifact_id in removed:
-        logger.debug("Removing artifact %s", artifact_id)
-        try:
-            shutil.rmtree(os.path.join(outdir, artifact_id))
-        except (OSError) as e:
-            logger.error("Error removing artifact: %s", e)
-            continue
+        removed = current - set(artifacts)
+        metrics.incr('artifacts_removed', len(removed), target=os.path.basename(outdir))
+        with artifact_catalog:
+            for artifact_id in removed:
+                logger.debug("Removing artifact %s", artifact_id)
+                try:
+                    changes.deleted(os.path.join(outdir, artifact_id))
+                    shutil.rmtree(os.path.join(outdir, artifact_id))
+                except (OSError) as e:
+                    logger.error("Error removing artifact: %s", e)
+                    continue
+                artifact_catalog.remove(artifact_id)
+    finally:
+        artifact_catalog.close()
 
     return added, len(removed)
 
 
 def delete_old_artifacts(target_dir, versions_to_keep):
-    for artifact_id in os.listdir(target_dir):
-        artifact_dir = os.path.join(target_dir, artifact_id)
-        if not os.path.isdir(artifact_dir):
-            continue
+    artifact_catalog = catalog.Catalog(target_dir)
+    try:
+        with artifact_catalog:
+            for artifact_id in artifact_catalog.artifact_dirs():
+                artifact_dir = os.path.join(target_dir, artifact_id)
+                zips = artifact_catalog.versions(artifact_id)
+                if len(zips) <= versions_to_keep:
+                    continue
 
-        zips = [name for name in os.listdir(artifact_dir) if os.path.splitext(name)[1] == '.zip']
-        if len(zips) <= versions_to_keep:
-            continue
+                for filename in zips[versions_to_keep:]:
+                    logger.debug("Removing old artifact %s", filename)
+                    changes.deleted(os.path.join(artifact_dir, filename))
+                    try:
+                        os.remove(os.path.join(artifact_dir, filename))
+                    except OSError:
+                        # removed behind the catalog's back
+                        if os.path.exists(os.path.join(artifact_dir, filename)):
+                            raise
+                    artifact_catalog.remove(artifact_id, filename)
+                    metrics.incr('old_versions_removed', target=os.path.basename(target_dir))
 
-        version_from_name = lambda name: os.path.splitext(name)[0].rsplit('-', 1)[1]
-        zips.sort(key=lambda _: LooseVersion(version_from_name(_)), reverse=True)
-
-        for filename in zips[versions_to_keep:]:
-            logger.debug("Removing old artifact %s", filename)
-            os.remove(os.path.join(artifact_dir, filename))
-
-            # TODO: remove after krypton
-            changelog = os.path.join(artifact_dir, 'changelog-%s.txt' % version_from_name(filename))
-            if os.path.exists(changelog):
-                os.remove(changelog)
+                    # TODO: remove after krypton
+                    changelog = os.path.join(artifact_dir, 'changelog-%s.txt' % catalog.split_filename(filename)[1])
+                    if os.path.exists(changelog):
+                        changes.deleted(changelog)
+                        os.remove(changelog)
+    finally:
+        artifact_catalog.close()
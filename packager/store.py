@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+#
+#     Copyright (C) 2015 Team Kodi
+#     http://kodi.tv
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import logging
+import os
+import shutil
+
+from packager import metrics
+
+logger = logging.getLogger(__name__)
+
+# Directory of the content-addressed store that published files are hard links to. Disabled when not set.
+store_dir = None
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def add(path):
+    """ Adds the content of file `path` to the store and returns the path of the stored object. """
+    digest = file_hash(path)
+    obj = os.path.join(store_dir, digest[:2], digest[2:])
+    if os.path.exists(obj):
+        metrics.incr('store_hits')
+        return obj
+
+    metrics.incr('store_misses')
+    try:
+        os.makedirs(os.path.dirname(obj))
+    except OSError:
+        pass
+    # another process may add the same content at the same time, so the object appears atomically
+    tmp = '%s.%d.tmp' % (obj, os.getpid())
+    try:
+        os.link(path, tmp)
+    except OSError:
+        shutil.copy2(path, tmp)
+    os.rename(tmp, obj)
+    return obj
+
+
+def gc():
+    """ Removes the objects no published file links to anymore. Returns the number of removed objects. """
+    removed = 0
+    for root, dirs, files in os.walk(store_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            if os.stat(path).st_nlink == 1:
+                logger.debug("Removing unreferenced object %s", path)
+                os.remove(path)
+                removed += 1
+    metrics.incr('store_objects_removed', removed)
+    return removed
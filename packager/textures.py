@@ -17,35 +17,95 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import hashlib
 import logging
+import shutil
 import subprocess
+import tempfile
+from distutils.spawn import find_executable
+from multiprocessing.pool import ThreadPool
+
+from packager import metrics
 
 logger = logging.getLogger(__name__)
 texturepacker_binary = 'TexturePacker'
+texturepacker_jobs = 1
+
+# Persistent cache of TexturePacker output keyed by the content of its input. Disabled when not set.
+cache_dir = None
+cache_max_size = 2 * 1024 * 1024 * 1024
+_texturepacker_identity = None
+
+
+def texture_dirs(xml):
+    """ Returns the top level directories of an addon that pack_textures reads and replaces by .xbt files. """
+    dirs = []
+    if xml.find("./extension[@point='xbmc.gui.skin']") is not None:
+        dirs += ['media', 'themes']
+    if xml.find("./extension[@compile='true']") is not None:
+        dirs += ['resources']
+    return dirs
 
 
 def pack_textures(xml, working_dir):
     is_skin = xml.find("./extension[@point='xbmc.gui.skin']") is not None
     compile = xml.find("./extension[@compile='true']") is not None
 
+    jobs = []
     if is_skin:
-        run_texturepacker(os.path.join(working_dir, 'media'),
-                          os.path.join(working_dir, 'media', 'Textures.xbt'))
+        jobs.append((os.path.join(working_dir, 'media'),
+                     os.path.join(working_dir, 'media', 'Textures.xbt')))
 
         if os.path.exists(os.path.join(working_dir, 'themes')):
             for theme_name in os.listdir(os.path.join(working_dir, 'themes')):
-                run_texturepacker(os.path.join(working_dir, 'themes', theme_name),
-                                  os.path.join(working_dir, 'media', theme_name + '.xbt'))
+                jobs.append((os.path.join(working_dir, 'themes', theme_name),
+                             os.path.join(working_dir, 'media', theme_name + '.xbt')))
+
+    if compile:
+        jobs.append((os.path.join(working_dir, 'resources'),
+                     os.path.join(working_dir, 'resources', 'Textures.xbt')))
+
+    run_texturepacker_jobs(jobs)
 
+    if is_skin:
         remove_non_xbt_files(os.path.join(working_dir, 'media'))
         remove_non_xbt_files(os.path.join(working_dir, 'themes'))
 
     if compile:
-        run_texturepacker(os.path.join(working_dir, 'resources'),
-                          os.path.join(working_dir, 'resources', 'Textures.xbt'))
         remove_non_xbt_files(os.path.join(working_dir, 'resources'))
 
 
+def _run_texturepacker_job(job):
+    run_texturepacker(*job)
+
+
+def run_texturepacker_jobs(jobs):
+    """
+    Runs a list of (input, output) TexturePacker invocations, up to `texturepacker_jobs` at a time, and
+    raises like `run_texturepacker` if any of them fails. Outputs are written to a staging directory and
+    only moved in place once all jobs are done, so no job sees another one's output in its input.
+    """
+    staging_dir = tempfile.mkdtemp()
+    try:
+        staged = [(input, os.path.join(staging_dir, "%d.xbt" % i)) for i, (input, output) in enumerate(jobs)]
+        if texturepacker_jobs <= 1 or len(staged) <= 1:
+            for job in staged:
+                _run_texturepacker_job(job)
+        else:
+            pool = ThreadPool(min(texturepacker_jobs, len(staged)))
+            try:
+                pool.map(_run_texturepacker_job, staged, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+
+        for (_, staged_output), (_, output) in zip(staged, jobs):
+            if os.path.exists(staged_output):
+                shutil.move(staged_output, output)
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+
 def remove_non_xbt_files(directory):
     for root, dirs, files in os.walk(directory, topdown=False):
         for name in files:
@@ -55,11 +115,78 @@ def remove_non_xbt_files(directory):
             os.rmdir(os.path.join(root, name))
 
 
+def texturepacker_identity():
+    """ Identifies the TexturePacker build in use, so that a rebuilt binary does not get stale cache hits. """
+    global _texturepacker_identity
+    if _texturepacker_identity is None:
+        path = os.path.realpath(find_executable(texturepacker_binary) or texturepacker_binary)
+        stat = os.stat(path)
+        _texturepacker_identity = "%s:%d:%d" % (path, stat.st_size, stat.st_mtime)
+    return _texturepacker_identity
+
+
+def hash_directory(directory):
+    digest = hashlib.sha256(texturepacker_identity().encode('utf-8'))
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            digest.update(b'\0' + os.path.relpath(path, start=directory).encode('utf-8') + b'\0')
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    digest.update(chunk)
+    return digest.hexdigest()
+
+
+def store_in_cache(output, cached):
+    fd, tmp = tempfile.mkstemp(dir=cache_dir)
+    os.close(fd)
+    shutil.copyfile(output, tmp)
+    os.rename(tmp, cached)
+    evict_from_cache()
+
+
+def evict_from_cache():
+    """ Removes the least recently used entries until the cache fits in `cache_max_size`. """
+    entries = []
+    for name in os.listdir(cache_dir):
+        try:
+            stat = os.stat(os.path.join(cache_dir, name))
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, name))
+
+    total = sum(size for _, size, _ in entries)
+    for mtime, size, name in sorted(entries):
+        if total <= cache_max_size:
+            break
+        logger.debug("Evicting %s from texture cache", name)
+        try:
+            os.remove(os.path.join(cache_dir, name))
+        except OSError:
+            pass
+        total -= size
+
+
 def run_texturepacker(input, output):
+    if cache_dir is not None:
+        cached = os.path.join(cache_dir, hash_directory(input) + '.xbt')
+        if os.path.exists(cached):
+            logger.debug("Using cached textures for %s", input)
+            shutil.copyfile(cached, output)
+            os.utime(cached, None)
+            metrics.incr('texture_cache_hits')
+            return
+        metrics.incr('texture_cache_misses')
+
     logger.debug("Running texturepacker on %s ...", input)
     cmd = [texturepacker_binary, '-dupecheck', '-input', input, '-output', output]
-    with open(os.devnull, 'w') as f:
-        subprocess.check_call(cmd, stdout=f, stderr=f)
+    with metrics.timed('texturepacker'):
+        with open(os.devnull, 'w') as f:
+            subprocess.check_call(cmd, stdout=f, stderr=f)
+
+    if cache_dir is not None and os.path.exists(output):
+        store_in_cache(output, cached)
 
 def check_texturepacker():
     with open(os.devnull, 'w') as f:
@@ -17,15 +17,22 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import contextlib
+import multiprocessing
 import os
 import logging
 import shutil
 import tempfile
+import time
 from xml.etree import ElementTree as ET
 from packager.textures import pack_textures
 import zipfile
+from packager import changes
+from packager import metrics
+from packager import store
+from packager import zipwriter
 
 logger = logging.getLogger(__name__)
+workers = 1
 
 def makedirs_ignore_errors(path):
     try:
@@ -35,14 +42,36 @@ def makedirs_ignore_errors(path):
 
 
 @contextlib.contextmanager
-def tempdir():
-    directory = tempfile.mkdtemp()
+def tempdir(dir=None):
+    directory = tempfile.mkdtemp(dir=dir)
     try:
         yield directory
     finally:
         shutil.rmtree(directory, ignore_errors=True)
 
 
+def link_tree(src, dst):
+    """
+    Like copy_tree, but hard links files where possible instead of copying them. When the store is enabled,
+    the files are linked to its objects so that identical files share their storage.
+    """
+    for root, dirs, files in os.walk(src):
+        dst_root = os.path.join(dst, os.path.relpath(root, start=src))
+        makedirs_ignore_errors(dst_root)
+        for name in files:
+            dst_path = os.path.join(dst_root, name)
+            changes.written(dst_path)
+            if os.path.exists(dst_path):
+                os.remove(dst_path)
+            src_path = os.path.join(root, name)
+            if store.store_dir is not None:
+                src_path = store.add(src_path)
+            try:
+                os.link(src_path, dst_path)
+            except OSError:
+                shutil.copy2(src_path, dst_path)
+
+
 def delete_companion_files(path):
     for name in os.listdir(path):
         # TODO: remove after krypton
@@ -50,6 +79,7 @@ def delete_companion_files(path):
             continue
 
         if os.path.splitext(name)[1] != '.zip':
+            changes.deleted(os.path.join(path, name))
             try:
                 if os.path.isdir(os.path.join(path, name)):
                     shutil.rmtree(os.path.join(path, name))
@@ -68,36 +98,95 @@ def meets_version_requirements(imports, min_versions):
     return True
 
 
-def pack_artifact(artifact, src_dir, dst_dir):
-    xml = ET.parse(os.path.join(src_dir, 'addon.xml'))
-    pack_textures(xml, src_dir)
-
-    # Copy asset files
+def companion_files(artifact, xml):
+    """
+    Returns (source, destination, required) tuples of the files that are published next to the zip. Paths
+    are relative to the addon directory. Files that are not required are only copied if they exist.
+    """
     assets = xml.find("./extension[@point='kodi.addon.metadata']/assets")
     if assets is None:
         assets = xml.find("./extension[@point='xbmc.addon.metadata']/assets")
 
     if assets is not None:
-        for item in assets:
-            if item.text:
-                makedirs_ignore_errors(os.path.join(dst_dir, os.path.dirname(item.text)))
-                shutil.copyfile(os.path.join(src_dir, item.text), os.path.join(dst_dir, item.text))
+        return [(item.text, item.text, True) for item in assets if item.text]
 
-    else:  # for backwards compatibility with add-ons that do not use the assets element
-        if os.path.exists(os.path.join(src_dir, "icon.png")):
-            shutil.copyfile(os.path.join(src_dir, "icon.png"), os.path.join(dst_dir, "icon.png"))
+    # for backwards compatibility with add-ons that do not use the assets element
+    return [("icon.png", "icon.png", False),
+            ("fanart.jpg", "fanart.jpg", False),
+            ("changelog.txt", "changelog-%s.txt" % artifact.version, False)]
 
-        if os.path.exists(os.path.join(src_dir, "fanart.jpg")):
-            shutil.copyfile(os.path.join(src_dir, "fanart.jpg"), os.path.join(dst_dir, "fanart.jpg"))
 
-        if os.path.exists(os.path.join(src_dir, "changelog.txt")):
-            shutil.copyfile(os.path.join(src_dir, "changelog.txt"), os.path.join(dst_dir, "changelog-%s.txt" % artifact.version))
+def pack_artifact(artifact, src_dir, dst_dir):
+    xml = ET.parse(os.path.join(src_dir, 'addon.xml'))
+    pack_textures(xml, src_dir)
+
+    # Copy asset files
+    for src, dst, required in companion_files(artifact, xml):
+        if required or os.path.exists(os.path.join(src_dir, src)):
+            makedirs_ignore_errors(os.path.join(dst_dir, os.path.dirname(dst)))
+            shutil.copyfile(os.path.join(src_dir, src), os.path.join(dst_dir, dst))
 
     # Write and compress files in src_dir to the final zip file
     dest_file = os.path.join(dst_dir, "%s-%s.zip" % (artifact.addon_id, artifact.version))
     with zipfile.ZipFile(dest_file, 'w', zipfile.ZIP_DEFLATED) as zf:
-        for root, dirs, files in os.walk(src_dir):
-            for name in files:
-                local_path = os.path.join(root, name)
-                archive_dest = artifact.addon_id + '/' + os.path.relpath(local_path, start=src_dir)
-                zf.write(local_path, archive_dest)
+        zipwriter.write_tree(zf, src_dir, artifact.addon_id + '/')
+
+
+def _package_one(job):
+    write_artifact, name, artifact, dest = job
+    target = os.path.basename(os.path.dirname(dest))
+    texturepacker_seconds = metrics.value('texturepacker_seconds')
+    start = time.time()
+    try:
+        write_artifact(artifact, dest)
+        success = True
+    except Exception:
+        logger.error("Failed to package %s:", artifact, exc_info=1)
+        success = False
+
+    zip_file = os.path.join(dest, "%s-%s.zip" % (artifact.addon_id, artifact.version))
+    size = os.path.getsize(zip_file) if success and os.path.exists(zip_file) else 0
+    metrics.incr('artifacts_packaged' if success else 'artifacts_failed', target=target)
+    metrics.incr('bytes_written', size, target=target)
+    metrics.record_artifact(name=name, target=target, success=success, bytes=size, seconds=time.time() - start,
+                            texturepacker_seconds=metrics.value('texturepacker_seconds') - texturepacker_seconds)
+    return success
+
+
+def _package_in_worker(job):
+    # name the worker after the artifact so log records can be attributed to it
+    multiprocessing.current_process().name = job[1]
+    changes.reset()
+    metrics.reset()
+    return _package_one(job), changes.collect(), metrics.collect()
+
+
+def package_artifacts(write_artifact, jobs, catalog=None):
+    """
+    Calls `write_artifact(artifact, dest)` for each (name, artifact, dest) tuple in `jobs` and returns a
+    list of booleans telling which ones succeeded. Runs in a pool of `workers` processes when more than one
+    worker is configured. A failing artifact is logged and does not affect the others. The zips written
+    successfully are added to `catalog` if one is given.
+    """
+    jobs = [(write_artifact, name, artifact, dest) for name, artifact, dest in jobs]
+    if workers <= 1 or len(jobs) <= 1:
+        results = [_package_one(job) for job in jobs]
+    else:
+        pool = multiprocessing.Pool(min(workers, len(jobs)))
+        try:
+            results = pool.map(_package_in_worker, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+        for _, job_changes, job_metrics in results:
+            changes.merge(job_changes)
+            metrics.merge(job_metrics)
+        results = [success for success, _, _ in results]
+
+    if catalog is not None:
+        with catalog:
+            for (_, _, artifact, dest), success in zip(jobs, results):
+                if success:
+                    catalog.add(os.path.basename(dest), "%s-%s.zip" % (artifact.addon_id, artifact.version))
+    return results
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+#
+#     Copyright (C) 2015 Team Kodi
+#     http://kodi.tv
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import os
+import time
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+logger = logging.getLogger(__name__)
+
+# Seconds between two scans of the binary repos when inotify is not available
+poll_interval = 2
+
+# Depth of the addon directories below a binary location: <location>/<branch>/<addon_id+platform>
+_ADDON_DIR_DEPTH = 2
+
+
+def list_dirs(path):
+    try:
+        return [os.path.join(path, name) for name in os.listdir(path) if os.path.isdir(os.path.join(path, name))]
+    except OSError:
+        return []
+
+
+class Watcher(object):
+    """
+    Reports the binary addon directories below `locations` whose content changed. A directory is reported
+    once no change happened in it for `debounce` seconds, so that zips that are still being copied are not
+    picked up half-written.
+    """
+
+    def __init__(self, locations, debounce):
+        self.locations = [os.path.normpath(location) for location in locations]
+        self.debounce = debounce
+        self.pending = {}
+
+    def events(self, timeout):
+        """ Waits at most `timeout` seconds for changes and returns the addon directories they happened in. """
+        raise NotImplementedError
+
+    def wait(self, timeout):
+        """ Returns the addon directories that settled within `timeout` seconds, or an empty set. """
+        deadline = time.time() + timeout
+        while True:
+            now = time.time()
+            ready = set(path for path, last_change in self.pending.items() if now - last_change >= self.debounce)
+            if ready:
+                for path in ready:
+                    del self.pending[path]
+                return ready
+            until = deadline
+            if self.pending:
+                until = min(until, min(self.pending.values()) + self.debounce)
+            if until <= now:
+                return set()
+            for path in self.events(until - now):
+                self.pending[path] = time.time()
+
+
+class PollingWatcher(Watcher):
+    """
+    Finds changes by polling the directory mtimes. Listings of the locations and branches are reused while
+    their mtime is unchanged, and only the addon directories whose mtime changed, or that are still settling,
+    are listed and have the sizes and mtimes of their zips compared. A zip rewritten in place under the same
+    name is therefore not noticed.
+    """
+
+    def __init__(self, locations, debounce):
+        super(PollingWatcher, self).__init__(locations, debounce)
+        self.listings = {}
+        self.snapshot = {}
+        self.scan()
+
+    def list_dirs(self, path):
+        """ Like list_dirs(), reusing the previous listing of `path` while its mtime is unchanged. """
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return []
+        entry = self.listings.get(path)
+        if entry is None or entry[0] != mtime:
+            entry = (mtime, list_dirs(path))
+            self.listings[path] = entry
+        return entry[1]
+
+    def scan(self):
+        """ Returns the addon directories whose content changed since the previous scan. """
+        changed = []
+        snapshot = {}
+        for location in self.locations:
+            for branch_dir in self.list_dirs(location):
+                for addon_dir in self.list_dirs(branch_dir):
+                    old = self.snapshot.get(addon_dir)
+                    try:
+                        mtime = os.stat(addon_dir).st_mtime
+                        if old is not None and old[0] == mtime and addon_dir not in self.pending:
+                            snapshot[addon_dir] = old
+                            continue
+                        zips = []
+                        for name in os.listdir(addon_dir):
+                            stat = os.stat(os.path.join(addon_dir, name))
+                            zips.append((name, stat.st_size, stat.st_mtime))
+                    except OSError:
+                        continue
+                    snapshot[addon_dir] = (mtime, sorted(zips))
+                    if snapshot[addon_dir] != old:
+                        changed.append(addon_dir)
+        self.snapshot = snapshot
+        return changed
+
+    def events(self, timeout):
+        time.sleep(min(timeout, poll_interval))
+        return self.scan()
+
+
+class InotifyWatcher(Watcher):
+    """ Watches every location, branch and addon directory with inotify. """
+
+    def __init__(self, locations, debounce):
+        super(InotifyWatcher, self).__init__(locations, debounce)
+        flags = inotify_simple.flags
+        self.mask = (flags.CREATE | flags.MODIFY | flags.CLOSE_WRITE | flags.MOVED_TO | flags.MOVED_FROM |
+                     flags.DELETE)
+        self.inotify = inotify_simple.INotify()
+        self.watches = {}
+        for location in self.locations:
+            self.add_watch(location, 0)
+
+    def add_watch(self, path, depth):
+        """ Watches `path` and the directories below it. Returns the addon directories found. """
+        try:
+            wd = self.inotify.add_watch(path, self.mask)
+        except OSError as e:
+            logger.warning("Cannot watch %s: %s", path, e)
+            return []
+        self.watches[wd] = (path, depth)
+        if depth == _ADDON_DIR_DEPTH:
+            return [path]
+        addon_dirs = []
+        for child in list_dirs(path):
+            addon_dirs += self.add_watch(child, depth + 1)
+        return addon_dirs
+
+    def events(self, timeout):
+        flags = inotify_simple.flags
+        changed = []
+        for event in self.inotify.read(timeout=int(timeout * 1000)):
+            if event.mask & flags.IGNORED:
+                self.watches.pop(event.wd, None)
+                continue
+            if event.wd not in self.watches:
+                continue
+            path, depth = self.watches[event.wd]
+            if depth == _ADDON_DIR_DEPTH:
+                changed.append(path)
+            elif event.mask & flags.ISDIR and event.mask & (flags.CREATE | flags.MOVED_TO):
+                # files may have arrived before the new directory was watched
+                changed += self.add_watch(os.path.join(path, event.name), depth + 1)
+        return changed
+
+
+def create(locations, debounce):
+    """ Returns a watcher for the binary repos at `locations`, using inotify if inotify_simple is installed. """
+    if inotify_simple is not None:
+        return InotifyWatcher(locations, debounce)
+    logger.info("inotify_simple is not installed, polling the binary repos every %d seconds", poll_interval)
+    return PollingWatcher(locations, debounce)
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+#
+#     Copyright (C) 2015 Team Kodi
+#     http://kodi.tv
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import struct
+import time
+import zipfile
+import zlib
+from multiprocessing.pool import ThreadPool
+
+_LOCAL_HEADER_SIZE = 30
+_LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+_FLAG_DATA_DESCRIPTOR = 0x08
+_CHUNK_SIZE = 1024 * 1024
+# members compressed together hold at most about this many bytes in memory
+_WINDOW_SIZE = 64 * 1024 * 1024
+
+# Number of threads compressing the members of one zip at the same time
+threads = 1
+# Deflate level by lowercase file extension, '*' for all others. Files with level 0 are stored uncompressed.
+levels = {'*': 6}
+
+# Write zips whose bytes only depend on their content: entries in sorted order, with a fixed timestamp
+# and normalized permissions
+reproducible = False
+REPRODUCIBLE_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+
+def normalized(info):
+    """ Returns `info`, with its timestamp and permissions normalized when `reproducible` is set. """
+    if reproducible:
+        mode = info.external_attr >> 16 if info.create_system == 3 else 0
+        file_type = mode & 0o170000 or 0o100000
+        info.date_time = REPRODUCIBLE_DATE_TIME
+        info.create_system = 3
+        info.external_attr = (file_type | (0o755 if mode & 0o111 else 0o644)) << 16
+    return info
+
+
+def member_data_offset(zf, info):
+    """ Returns the offset of the (compressed) data of member `info` in the file of `zf`. """
+    zf.fp.seek(info.header_offset)
+    header = zf.fp.read(_LOCAL_HEADER_SIZE)
+    if header[0:4] != _LOCAL_HEADER_SIGNATURE:
+        raise zipfile.BadZipfile("Bad local file header of %s" % info.filename)
+    name_length, extra_length = struct.unpack('<HH', header[26:30])
+    return info.header_offset + _LOCAL_HEADER_SIZE + name_length + extra_length
+
+
+def write_raw(zf, info, chunks):
+    """
+    Appends a member to `zf` whose data is already compressed. `info` must describe the data (compression
+    type, CRC and both sizes); `chunks` yields the compressed bytes.
+    """
+    # python 3 keeps track of where the next member goes, python 2 writes at the current position
+    if hasattr(zf, 'start_dir'):
+        zf.fp.seek(zf.start_dir)
+    info.header_offset = zf.fp.tell()
+    zf.fp.write(info.FileHeader())
+    for chunk in chunks:
+        zf.fp.write(chunk)
+    zf.filelist.append(info)
+    zf.NameToInfo[info.filename] = info
+    zf._didModify = True
+    if hasattr(zf, 'start_dir'):
+        zf.start_dir = zf.fp.tell()
+
+
+def compress(member):
+    """
+    Compresses the data of `member`, a (ZipInfo, data) pair, with the level `levels` gives for its file
+    extension. Fills in the compression type, CRC and sizes of the ZipInfo and returns it with the
+    compressed data.
+    """
+    info, data = member
+    extension = os.path.splitext(info.filename)[1].lower()
+    level = levels.get(extension, levels.get('*', 6))
+    info.CRC = zlib.crc32(data) & 0xFFFFFFFF
+    info.file_size = len(data)
+    if level == 0:
+        info.compress_type = zipfile.ZIP_STORED
+    else:
+        info.compress_type = zipfile.ZIP_DEFLATED
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        data = compressor.compress(data) + compressor.flush()
+    info.compress_size = len(data)
+    return info, data
+
+
+def write_members(zf, members):
+    """
+    Adds `members`, (ZipInfo, data) pairs, to `zf` in order. With more than one thread, a window of
+    members is compressed in parallel (zlib releases the GIL) before it is written.
+    """
+    if threads <= 1:
+        for member in members:
+            info, data = compress(member)
+            write_raw(zf, info, [data])
+        return
+
+    def flush(window):
+        for info, data in pool.map(compress, window):
+            write_raw(zf, info, [data])
+
+    pool = ThreadPool(threads)
+    try:
+        window = []
+        size = 0
+        for member in members:
+            window.append(member)
+            size += len(member[1])
+            if len(window) >= threads * 4 or size >= _WINDOW_SIZE:
+                flush(window)
+                window = []
+                size = 0
+        flush(window)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def tree_files(src_dir, prefix):
+    """ Returns (arcname, path) of the files below `src_dir` sorted by arcname, `prefix` + their relative path. """
+    paths = []
+    for root, dirs, files in os.walk(src_dir):
+        for name in files:
+            local_path = os.path.join(root, name)
+            paths.append((prefix + os.path.relpath(local_path, start=src_dir).replace(os.sep, '/'), local_path))
+    return sorted(paths)
+
+
+def file_member(arcname, local_path):
+    """ Returns the (ZipInfo, data) pair adding file `local_path` as `arcname`. """
+    st = os.stat(local_path)
+    info = zipfile.ZipInfo(arcname, time.localtime(st.st_mtime)[:6])
+    info.create_system = 3
+    info.external_attr = (st.st_mode & 0xFFFF) << 16
+    with open(local_path, 'rb') as f:
+        data = f.read()
+    return normalized(info), data
+
+
+def write_tree(zf, src_dir, prefix):
+    """ Adds the files below `src_dir` to `zf` in sorted order, named `prefix` + their relative path. """
+    write_members(zf, (file_member(arcname, local_path) for arcname, local_path in tree_files(src_dir, prefix)))
+
+
+def copy_member(src_zf, info, dst_zf, arcname=None):
+    """
+    Copies member `info` of `src_zf` to `dst_zf` without decompressing and compressing it again. Members
+    compressed with other methods than deflate are recompressed, so that the copy is stored or deflated.
+    """
+    new_info = zipfile.ZipInfo(arcname or info.filename, info.date_time)
+    new_info.create_system = info.create_system
+    new_info.external_attr = info.external_attr
+    if info.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+        new_info, data = compress((normalized(new_info), src_zf.read(info)))
+        write_raw(dst_zf, new_info, [data])
+        return
+
+    new_info.compress_type = info.compress_type
+    new_info.CRC = info.CRC
+    new_info.compress_size = info.compress_size
+    new_info.file_size = info.file_size
+    # sizes and CRC are known up front, so the copy never needs a data descriptor
+    new_info.flag_bits = info.flag_bits & ~_FLAG_DATA_DESCRIPTOR
+    normalized(new_info)
+
+    def chunks():
+        src_zf.fp.seek(member_data_offset(src_zf, info))
+        remaining = info.compress_size
+        while remaining > 0:
+            chunk = src_zf.fp.read(min(_CHUNK_SIZE, remaining))
+            if not chunk:
+                raise zipfile.BadZipfile("Truncated data of %s" % info.filename)
+            remaining -= len(chunk)
+            yield chunk
+
+    write_raw(dst_zf, new_info, chunks())
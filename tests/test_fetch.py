@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+#
+#     Copyright (C) 2015 Team Kodi
+#     http://kodi.tv
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import packager.gitbackend
+import updaterepo
+
+
+def git(repo, *args):
+    env = dict(os.environ, GIT_AUTHOR_NAME='test', GIT_AUTHOR_EMAIL='test@localhost',
+               GIT_COMMITTER_NAME='test', GIT_COMMITTER_EMAIL='test@localhost')
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(['git'] + list(args), cwd=repo, env=env, stdout=devnull)
+
+
+def commit(repo, message):
+    with open(os.path.join(repo, 'file.txt'), 'wb') as f:
+        f.write(message.encode('utf-8'))
+    git(repo, 'add', '-A')
+    git(repo, 'commit', '-q', '-m', message)
+    return rev_parse(repo, 'HEAD')
+
+
+def rev_parse(repo, rev):
+    return subprocess.check_output(['git', 'rev-parse', rev], cwd=repo).strip().decode('ascii')
+
+
+class FetchSourcesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.clones = []
+        for name, branches in [('full', ['master', 'krypton']), ('partial', ['master'])]:
+            upstream = os.path.join(self.root, 'upstream-' + name)
+            os.makedirs(upstream)
+            git(upstream, 'init', '-q')
+            commit(upstream, 'initial')
+            git(upstream, 'branch', '-M', 'master')
+            for branch in branches[1:]:
+                git(upstream, 'branch', branch)
+            clone = os.path.join(self.root, name)
+            git(self.root, 'clone', '-q', upstream, clone)
+            self.clones.append((upstream, clone))
+
+    def tearDown(self):
+        packager.gitbackend.close_all()
+        shutil.rmtree(self.root)
+
+    def test_repo_without_branch(self):
+        (full_upstream, full), (partial_upstream, partial) = self.clones
+        git(full_upstream, 'checkout', '-q', 'krypton')
+        krypton = commit(full_upstream, 'krypton change')
+        master = commit(partial_upstream, 'master change')
+
+        updaterepo.fetch_sources([full, partial], 'origin', set(['master', 'krypton']))
+
+        self.assertEqual(rev_parse(full, 'origin/krypton'), krypton)
+        self.assertEqual(rev_parse(partial, 'origin/master'), master)
+        self.assertIsNone(packager.gitbackend.get_backend(partial).resolve('origin/krypton'))
+
+    def test_remote_not_listed_when_branches_exist(self):
+        (full_upstream, full), _ = self.clones
+        master = commit(full_upstream, 'master change')
+        backend = packager.gitbackend.get_backend(full)
+
+        def remote_branches(remote):
+            raise AssertionError("remote listed although no branch is missing")
+        backend.remote_branches = remote_branches
+
+        updaterepo.fetch_sources([full], 'origin', set(['master', 'krypton']))
+
+        self.assertEqual(rev_parse(full, 'origin/master'), master)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,19 +1,18 @@
 #!/bin/bash
 echo "=================================================================="
 echo "$(date -Ins) Repository update started"
-echo "$(date -Ins) - Running updaterepo.py"
-./updaterepo.py || exit 1
-echo "$(date -Ins) - Running update_indexes.py"
-./update_indexes.py
+echo "$(date -Ins) - Running updaterepo.py --index"
+./updaterepo.py --index
 index_status=$?
+if [ $index_status -ne 0 ] && [ $index_status -ne 64 ]; then
+	exit 1
+fi
 if [ -f mirrorsync.sh ]; then
 	if [ $index_status -eq 64 ]; then
 		echo "$(date -Ins) - No index files changed, skipping mirror sync"
-	elif [ $index_status -eq 0 ]; then
+	else
 		echo "$(date -Ins) - Triggering mirror sync"
 		./mirrorsync.sh || exit 1
-	else
-		exit 1
 	fi
 fi
 echo "$(date -Ins) Repository update finished"
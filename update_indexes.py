@@ -17,9 +17,11 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import multiprocessing
 import os
 import sys
 from indexer import indexer
+from packager import changes
 try:
     from ConfigParser import ConfigParser
 except ImportError:
@@ -30,15 +32,38 @@ if not config.read('config.cfg'):
     print("Fatal: Could not read config file.")
     sys.exit(1)
 
+index_options = indexer.index_options(config)
+
+
+def index_target(target_path):
+    changes.reset()
+    changed = indexer.create_index(target_path, os.path.join(target_path, "addons.xml"), **index_options)
+    return changed, changes.collect()
+
 
 if __name__ == '__main__':
     outdir = config.get('general', 'destination')
-    file_changed = False
-    for target_name in os.listdir(outdir):
-        target_path = os.path.join(outdir, target_name)
-        if os.path.isdir(target_path):
-            file_changed |= indexer.create_index(target_path, os.path.join(target_path, "addons.xml"))
+    workers = config.getint('general', 'workers') if config.has_option('general', 'workers') else 1
+
+    targets = [os.path.join(outdir, name) for name in sorted(os.listdir(outdir))
+               if not name.startswith('.') and os.path.isdir(os.path.join(outdir, name))]
+    if workers > 1 and len(targets) > 1:
+        pool = multiprocessing.Pool(min(workers, len(targets)))
+        try:
+            results = pool.map(index_target, targets, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [index_target(target_path) for target_path in targets]
+
+    for _, target_changes in results:
+        changes.merge(target_changes)
+    if config.has_option('general', 'change_manifest'):
+        # adds the index files to the manifest of the preceding updaterepo.py run
+        changes.save(config.get('general', 'change_manifest'), outdir, append=True)
 
+    file_changed = any(changed for changed, _ in results)
     if not file_changed:
         # Special exit code 64 indicates that no files were changed
         sys.exit(64)
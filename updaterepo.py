@@ -19,13 +19,27 @@
 
 import os
 import shutil
-import git
 import sys
+import time
 import logging
+import multiprocessing
+from argparse import ArgumentParser
 import packager
+import packager.binarypackaging
+import packager.cache
+import packager.catalog
+import packager.changes
+import packager.gitbackend
+import packager.gitpackaging
+import packager.metrics
+import packager.store
 import packager.textures
+import packager.utils
+import packager.watcher
+import packager.zipwriter
 from distutils.version import LooseVersion
 from io import BytesIO
+from multiprocessing.pool import ThreadPool
 
 try:
     from ConfigParser import ConfigParser
@@ -40,22 +54,66 @@ Target = namedtuple('Target', ['name', 'branches', 'min_versions'])
 config = ConfigParser()
 logger = logging.getLogger("updaterepo")
 
+# Add the changes of a run to the change manifest instead of replacing it. Set in daemon mode, where runs
+# follow each other without anything consuming the manifest in between.
+append_changes = False
+
+
+def branch_refspec(remote_name, branch):
+    return '+refs/heads/%s:refs/remotes/%s/%s' % (branch, remote_name, branch)
+
+
+def fetch_branches(path, remote_name, branches):
+    """
+    Fetches those of `branches` that exist on the remote into the repo at `path`. Other branches of the
+    remote are not fetched. The remote is only asked for its branches when some of them are missing.
+    """
+    backend = packager.gitbackend.get_backend(path)
+    try:
+        backend.fetch(remote_name, [branch_refspec(remote_name, branch) for branch in sorted(branches)])
+        return
+    except KeyError:
+        pass
+
+    existing = backend.remote_branches(remote_name)
+    logger.debug("%s has no branch %s on %s. Skipping.", path, ", ".join(sorted(set(branches) - existing)),
+                 remote_name)
+    refspecs = [branch_refspec(remote_name, branch) for branch in sorted(set(branches) & existing)]
+    if refspecs:
+        backend.fetch(remote_name, refspecs)
+
+
+def fetch_sources(source_locations, remote_name, branches):
+    """ Fetches `branches` into all source repos at once. Repos that lack some of them fetch the others. """
+    def fetch(path):
+        logger.debug("Fetching %s", path)
+        fetch_branches(path, remote_name, branches)
+
+    pool = ThreadPool(len(source_locations))
+    try:
+        pool.map(fetch, source_locations)
+    finally:
+        pool.close()
+        pool.join()
+
 
 def read_targets():
     """
     Reads config file from the remove git configuration repo and returns the targets to generate
     addon repository for.
     """
-    repo = git.Repo(config.get('configuration_repo', 'location'))
+    location = config.get('configuration_repo', 'location')
+    backend = packager.gitbackend.get_backend(location)
     remote_name = config.get('configuration_repo', 'remote_name')
-    ref = remote_name + '/' + config.get('configuration_repo', 'branch')
+    branch = config.get('configuration_repo', 'branch')
+    ref = remote_name + '/' + branch
     filename = config.get('configuration_repo', 'filename')
 
     if config.getboolean('debug', 'fetch_remotes'):
-        repo.remotes[remote_name].fetch()
+        fetch_branches(location, remote_name, [branch])
 
     # python 2 workaround
-    content = repo.refs[ref].commit.tree[filename].data_stream.read()
+    content = backend.read_file(ref, filename)
     target_config = ConfigParser({'branches': None, 'minversions': None})
     target_config.readfp(BytesIO(content))
 
@@ -73,7 +131,27 @@ def read_targets():
         yield Target(target, branches, min_versions)
 
 
-def update_all_targets():
+def target_signature(target, remote_name, source_locations, binary_locations):
+    """
+    Returns what the output of `target` depends on: the target definition, the commits its refs point to
+    and the modification times of the addon directories in its binary repos.
+    """
+    commits = [packager.gitbackend.get_backend(path).resolve(remote_name + '/' + branch)
+               for path in source_locations for branch in target.branches]
+    binary_dirs = []
+    for repo_path in [location + '/' + branch for location in binary_locations for branch in target.branches]:
+        if os.path.isdir(repo_path):
+            for name in sorted(os.listdir(repo_path)):
+                binary_dirs.append((name, os.stat(os.path.join(repo_path, name)).st_mtime))
+    return target, commits, binary_dirs
+
+
+def update_all_targets(signatures=None, index=False):
+    """
+    Updates all targets, and indexes them too if `index` is set. When `signatures` returned by a previous
+    call is given, targets whose refs and binary repos did not change since are skipped. Returns the new
+    signatures, the updated targets and the names of the targets whose index changed.
+    """
     remote_name = config.get('source_repo', 'remote_name')
     outdir = config.get('general', 'destination')
     version_to_keep = config.getint('general', 'version_to_keep')
@@ -82,43 +160,232 @@ def update_all_targets():
 
     if not outdir:
         logger.fatal("No destination specified.")
-        return
+        return signatures, [], []
 
-    if config.getboolean('debug', 'fetch_remotes'):
-        for path in source_locations:
-            git.Repo(path).remotes[remote_name].fetch()
+    with packager.metrics.phase('read_targets'):
+        current_targets = list(read_targets())
 
-    current_targets = list(read_targets())
+    if config.getboolean('debug', 'fetch_remotes'):
+        with packager.metrics.phase('fetch'):
+            fetch_sources(source_locations, remote_name, set(b for t in current_targets for b in t.branches))
 
     # Delete targets that have been removed since last update
     previous_targets = [name for name in os.listdir(outdir) if not name.startswith('.')]
     removed_targets = set(previous_targets) - set([t.name for t in current_targets])
     for target in removed_targets:
         logger.debug("Deleting unknown target %s", target)
+        packager.changes.deleted(os.path.join(outdir, target))
         shutil.rmtree(os.path.join(outdir, target))
 
-    # Now update the active ones
+    new_signatures = {}
     for target in current_targets:
-        refs = [remote_name + '/' + branch for branch in target.branches]
+        new_signatures[target.name] = target_signature(target, remote_name, source_locations, binary_locations)
+    if signatures is not None:
+        current_targets = [t for t in current_targets if signatures.get(t.name) != new_signatures[t.name]]
+
+    # Packages shared by several targets are built once per run and linked into each of them
+    build_cache_dir = os.path.join(outdir, '.build-cache')
+    shutil.rmtree(build_cache_dir, ignore_errors=True)
+    os.makedirs(build_cache_dir)
+    packager.gitpackaging.build_cache_dir = build_cache_dir
+    try:
+        indexed, failed = update_targets(current_targets, outdir, remote_name, source_locations, binary_locations,
+                                         version_to_keep, index)
+    finally:
+        packager.gitpackaging.build_cache_dir = None
+        shutil.rmtree(build_cache_dir, ignore_errors=True)
+        if packager.store.store_dir is not None:
+            # objects of pruned versions, removed artifacts and removed targets have no links left
+            with packager.metrics.phase('store_gc'):
+                packager.store.gc()
+        save_changes(outdir)
+
+    for name in failed:
+        # not recording the signature makes the next daemon round retry the artifacts that failed
+        del new_signatures[name]
+    return new_signatures, current_targets, indexed
+
+
+def update_targets(current_targets, outdir, remote_name, source_locations, binary_locations, version_to_keep,
+                   index=False):
+    """
+    Packages and prunes each target. With `index` set, every finished target is handed to an index process
+    that works on it while the next target is packaged. Returns the names of the targets whose index changed
+    and the names of the targets that had artifacts fail to package.
+    """
+    # no process is forked when there is nothing to index, as in most daemon rounds
+    index_pool = None
+    if index and current_targets:
+        index_pool = multiprocessing.Pool(1, initializer=_init_index_process)
+    pending = []
+    failed = []
+    try:
+        for target in current_targets:
+            if update_target(target, outdir, remote_name, source_locations, binary_locations, version_to_keep):
+                failed.append(target.name)
+            if index_pool is not None:
+                dest = os.path.join(outdir, target.name)
+                # the index process looks the archives up in the catalog and reuses its cached <addon> elements
+                pending.append((target.name, index_pool.apply_async(index_target, (dest,))))
+
+        indexed = []
+        for name, result in pending:
+            changed, job_changes, job_metrics = result.get()
+            packager.changes.merge(job_changes)
+            packager.metrics.merge(job_metrics)
+            if changed:
+                indexed.append(name)
+        return indexed, failed
+    finally:
+        if index_pool is not None:
+            index_pool.close()
+            index_pool.join()
+
+
+def update_target(target, outdir, remote_name, source_locations, binary_locations, version_to_keep):
+    """ Packages and prunes `target`. Returns the number of artifacts that failed to package. """
+    refs = [remote_name + '/' + branch for branch in target.branches]
+    dest = os.path.join(outdir, target.name)
+    logger.info("============================ %s ============================", target.name)
+    logger.info("Branches: %s", target.branches)
+    logger.info("Min. versions: %s", target.min_versions)
+    logger.info("Destination: %s", dest)
+    try:
+        os.makedirs(dest)
+    except OSError:
+        pass
+
+    failed = packager.metrics.value('artifacts_failed', target=target.name)
+    added, removed = packager.update_changed_artifacts(source_locations, refs, [binary_location + '/' + branch for binary_location in binary_locations for branch in target.branches], target.min_versions, dest)
+    logger.info("Results: %d artifacts added, %d artifacts removed", added, removed)
+    packager.metrics.incr('artifacts_added', added, target=target.name)
+
+    logger.info("Purging old artifact version... To keep: %d", version_to_keep)
+    with packager.metrics.phase('prune', target=target.name):
+        packager.delete_old_artifacts(dest, version_to_keep)
+
+    return packager.metrics.value('artifacts_failed', target=target.name) - failed
+
+
+def _init_index_process():
+    multiprocessing.current_process().name = 'indexer'
+
+
+def create_target_index(dest):
+    """ Writes the index of target directory `dest`. Returns whether it changed. """
+    # imported here, the indexer configures logging when imported
+    from indexer import indexer
+
+    with packager.metrics.phase('index', target=os.path.basename(dest)):
+        return indexer.create_index(dest, os.path.join(dest, "addons.xml"), **indexer.index_options(config))
+
+
+def index_target(dest):
+    """ Like create_target_index, run in the index process. Also returns its changes and metrics. """
+    packager.changes.reset()
+    packager.metrics.reset()
+    changed = create_target_index(dest)
+    return changed, packager.changes.collect(), packager.metrics.collect()
+
+
+def update_binary_dirs(targets, addon_dirs):
+    """
+    Packages the new zips of the binary addon directories `addon_dirs` into the targets built from their
+    branch, and reindexes the targets that got new artifacts. Removed addons are left to the next full update.
+    """
+    outdir = config.get('general', 'destination')
+    version_to_keep = config.getint('general', 'version_to_keep')
+    binary_locations = config.get('binary_repo', 'locations').replace('\n', '').split(',')
+    addon_dirs = set(os.path.normpath(path) for path in addon_dirs)
+
+    for target in targets:
         dest = os.path.join(outdir, target.name)
-        logger.info("============================ %s ============================", target.name)
-        logger.info("Branches: %s", target.branches)
-        logger.info("Min. versions: %s", target.min_versions)
-        logger.info("Destination: %s", dest)
+        binary_repos = [location + '/' + branch for location in binary_locations for branch in target.branches]
+        repo_paths = set(os.path.normpath(repo_path) for repo_path in binary_repos)
+        names = sorted(set(os.path.basename(path) for path in addon_dirs if os.path.dirname(path) in repo_paths))
+        if not names or not os.path.isdir(dest):
+            continue
+
+        logger.info("Binary addons changed in %s: %s", target.name, ", ".join(names))
+        artifact_catalog = packager.catalog.Catalog(dest)
         try:
-            os.makedirs(dest)
-        except OSError:
-            pass
+            added, _ = packager.binarypackaging.update_changed_artifacts(
+                binary_repos, target.min_versions, dest, artifact_catalog, names)
+        finally:
+            artifact_catalog.close()
+        packager.metrics.incr('artifacts_added', added, target=target.name)
+        if added:
+            with packager.metrics.phase('prune', target=target.name):
+                packager.delete_old_artifacts(dest, version_to_keep)
+            create_target_index(dest)
 
-        added, removed = packager.update_changed_artifacts(source_locations, refs, [binary_location + '/' + branch for binary_location in binary_locations for branch in target.branches], target.min_versions, dest)
-        logger.info("Results: %d artifacts added, %d artifacts removed", added, removed)
+    if packager.store.store_dir is not None:
+        packager.store.gc()
+    save_changes(outdir)
 
-        logger.info("Purging old artifact version... To keep: %d", version_to_keep)
-        packager.delete_old_artifacts(dest, version_to_keep)
+
+def save_changes(outdir):
+    """ Writes the changes recorded under `outdir` to the change manifest, if one is configured. """
+    if config.has_option('general', 'change_manifest'):
+        packager.changes.save(config.get('general', 'change_manifest'), outdir, append=append_changes)
+
+
+def daemon_round(update, *args):
+    """ Runs `update` with a change manifest and metrics of its own. Returns its result, or None if it failed. """
+    start = time.time()
+    packager.changes.reset()
+    packager.metrics.reset()
+    try:
+        return update(*args)
+    except Exception:
+        logger.exception("Update failed")
+    finally:
+        write_metrics(start, time.time())
+
+
+def run_daemon(interval, watch=False):
+    """
+    Keeps updating the targets whose refs or binary repos changed, and indexes them, every `interval`
+    seconds. Repository handles and collected metadata stay in memory between rounds. With `watch` set,
+    new binary addons are packaged as soon as they settle in the binary repos, in between these rounds.
+    Every round adds its changes to the change manifest, which the mirror sync has to move away to take them.
+    """
+    global append_changes
+    append_changes = True
+    watcher = None
+    if watch:
+        debounce = config.getfloat('general', 'watch_debounce') if config.has_option('general', 'watch_debounce') else 2
+        watcher = packager.watcher.create(config.get('binary_repo', 'locations').replace('\n', '').split(','), debounce)
+
+    signatures = {}
+    while True:
+        start = time.time()
+        result = daemon_round(update_all_targets, signatures, True)
+        if result is not None:
+            signatures = result[0]
+
+        deadline = start + interval
+        while watcher is not None and time.time() < deadline:
+            addon_dirs = watcher.wait(deadline - time.time())
+            if addon_dirs:
+                targets = [signature[0] for signature in signatures.values()]
+                daemon_round(update_binary_dirs, targets, addon_dirs)
+        time.sleep(max(0, deadline - time.time()))
 
 
 def main():
-    filename = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(__file__), 'config.cfg')
+    parser = ArgumentParser()
+    parser.add_argument('config', nargs='?', default=os.path.join(os.path.dirname(__file__), 'config.cfg'))
+    parser.add_argument('--daemon', action='store_true', default=False,
+                        help="keep running and update targets as soon as their sources change")
+    parser.add_argument('--interval', type=int, default=None, help="seconds between checks in daemon mode")
+    parser.add_argument('--watch', action='store_true', default=False,
+                        help="daemon mode that also packages new binary addons as soon as they are copied")
+    parser.add_argument('--index', action='store_true', default=False,
+                        help="also index each target as soon as it is packaged. Exits with 64 if no index changed")
+    args = parser.parse_args()
+
+    filename = args.config
     if not config.read(filename):
         print("Fatal: Could not read config file '%s'" % filename)
         sys.exit(1)
@@ -134,8 +401,71 @@ def main():
         print("Fatal: Could not invoke TexturePacker with command '%s'" % packager.textures.texturepacker_binary)
         sys.exit(1)
 
-    logging.basicConfig(level=config.getint('debug', 'level'), format='%(levelname)s [%(name)s] %(message)s')
-    update_all_targets()
+    if config.has_option('general', 'cache_dir'):
+        packager.cache.cache_dir = config.get('general', 'cache_dir')
+    else:
+        packager.cache.cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache')
+
+    packager.textures.cache_dir = os.path.join(packager.cache.cache_dir, 'textures')
+    packager.utils.makedirs_ignore_errors(packager.textures.cache_dir)
+    if config.has_option('general', 'texture_cache_size'):
+        packager.textures.cache_max_size = config.getint('general', 'texture_cache_size') * 1024 * 1024
+
+    if config.has_option('general', 'texturepacker_jobs'):
+        packager.textures.texturepacker_jobs = config.getint('general', 'texturepacker_jobs')
+
+    if config.has_option('general', 'git_backend'):
+        packager.gitbackend.backend_name = config.get('general', 'git_backend')
+
+    if config.has_option('general', 'workers'):
+        packager.utils.workers = config.getint('general', 'workers')
+
+    if config.has_option('general', 'dedup') and config.getboolean('general', 'dedup'):
+        packager.store.store_dir = os.path.join(config.get('general', 'destination'), '.store')
+
+    if config.has_option('general', 'zip_threads'):
+        packager.zipwriter.threads = config.getint('general', 'zip_threads')
+    if config.has_option('general', 'zip_compression'):
+        for item in config.get('general', 'zip_compression').split(','):
+            if item.strip():
+                extension, level = item.strip().rsplit(':', 1)
+                packager.zipwriter.levels[extension.strip().lower()] = int(level)
+
+    if config.has_option('general', 'reproducible_zips'):
+        packager.zipwriter.reproducible = config.getboolean('general', 'reproducible_zips')
+
+    log_format = '%(levelname)s [%(name)s] %(message)s'
+    if packager.utils.workers > 1:
+        log_format = '%(levelname)s [%(processName)s] [%(name)s] %(message)s'
+    logging.basicConfig(level=config.getint('debug', 'level'), format=log_format)
+    if args.daemon or args.watch:
+        interval = args.interval
+        if interval is None:
+            interval = config.getint('general', 'daemon_interval') if config.has_option('general', 'daemon_interval') else 60
+        try:
+            run_daemon(interval, args.watch)
+        finally:
+            packager.gitbackend.close_all()
+        return
+
+    start = time.time()
+    try:
+        _, _, indexed = update_all_targets(index=args.index)
+    finally:
+        packager.gitbackend.close_all()
+        write_metrics(start, time.time())
+
+    if args.index and not indexed:
+        sys.exit(64)
+
+
+def write_metrics(start, end):
+    """ Exports the metrics of this run as a JSON report and/or a Prometheus textfile, if configured. """
+    if config.has_option('general', 'metrics_json'):
+        packager.metrics.write_json(config.get('general', 'metrics_json'), start=start, duration=end - start)
+    if config.has_option('general', 'metrics_prometheus'):
+        packager.metrics.write_prometheus(config.get('general', 'metrics_prometheus'),
+                                          last_run_timestamp_seconds=end, last_run_duration_seconds=end - start)
 
 if __name__ == '__main__':
     main()
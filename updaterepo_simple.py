@@ -18,7 +18,6 @@
 
 import os
 import sys
-import hashlib
 import logging
 from indexer.indexer import create_index
 import packager
@@ -37,12 +36,7 @@ def main():
     if added or removed:
         packager.delete_old_artifacts(outdir, 1)
 
-        create_index(outdir, os.path.join(outdir, "addons.xml"))
-        md5sum = hashlib.md5()
-        with open(os.path.join(outdir, "addons.xml.gz"), 'rb') as f:
-            md5sum.update(f.read())
-        with open(os.path.join(outdir, "addons.xml.gz.md5"), 'wb') as f:
-            f.write(md5sum.hexdigest())
+        create_index(outdir, os.path.join(outdir, "addons.xml"), checksums=['md5'])
 
 
 if __name__ == '__main__':